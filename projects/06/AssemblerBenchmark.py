@@ -0,0 +1,253 @@
+"""
+Throughput benchmark for HackAssembler.
+
+Every benchmark runs in a fresh interpreter so that its peak RSS is its own.
+It reports lines/sec, peak RSS and the time spent in each pass as JSON.
+Besides the shipped programs, synthetic programs of any size are generated
+with a configurable mix of labels, variables and C-instructions.
+
+    python AssemblerBenchmark.py --sizes 10000,100000 --output result.json
+    python AssemblerBenchmark.py --save-baseline baseline.json
+    python AssemblerBenchmark.py --baseline baseline.json --tolerance 0.15
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+from HackAssembler import HackAssembler, HackTextWriter
+
+
+SHIPPED_PROGRAMS = [
+    "add/Add.asm",
+    "max/Max.asm",
+    "rect/Rect.asm",
+    "pong/Pong.asm",
+]
+DEFAULT_SIZES = [10000, 100000, 1000000, 10000000]
+MODES = ["two-pass", "streaming", "two-pass-mmap"]
+MAX_TARGET_ADDRESS = 30000
+# variables are allocated from RAM address 16 and must stay below SCREEN
+MAX_VARIABLES = 16384 - 16
+# shorter runs are timer noise and are not compared against the baseline
+MIN_COMPARE_SECONDS = 0.1
+
+C_INSTRUCTIONS = [
+    "D=A",
+    "D=M",
+    "M=D",
+    "A=M",
+    "M=M+1",
+    "M=M-1",
+    "D=D+M",
+    "D=M-D",
+    "AM=M-1",
+    "D;JEQ",
+    "D;JGT",
+    "0;JMP",
+]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Measure HackAssembler throughput.")
+    arg_parser.add_argument(
+        "--sizes",
+        type=lambda text: [int(size) for size in text.split(",") if size],
+        default=DEFAULT_SIZES,
+        help="comma separated line counts of the generated programs",
+    )
+    arg_parser.add_argument("--label-ratio", type=float, default=0.05, help="share of label declarations")
+    arg_parser.add_argument("--variable-ratio", type=float, default=0.25, help="share of @variable references")
+    arg_parser.add_argument("--seed", type=int, default=0, help="seed of the program generator")
+    arg_parser.add_argument("--modes", type=lambda text: text.split(","), default=MODES, help="assembler modes")
+    arg_parser.add_argument("--no-shipped", action="store_true", help="skip the shipped programs")
+    arg_parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    arg_parser.add_argument("--baseline", help="fail if results regress past this earlier report")
+    arg_parser.add_argument("--save-baseline", help="also store the report as a baseline")
+    arg_parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="allowed relative regression of lines/sec and peak RSS against the baseline",
+    )
+    arg_parser.add_argument(
+        "--min-seconds",
+        type=float,
+        default=MIN_COMPARE_SECONDS,
+        help="only compare the lines/sec of runs that took at least this long",
+    )
+    arg_parser.add_argument("--run-one", nargs=2, metavar=("MODE", "FILE"), help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(_run_one(*args.run_one)))
+        return
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        programs = []
+        if not args.no_shipped:
+            for program in SHIPPED_PROGRAMS:
+                programs.append((program, os.path.join(here, program)))
+        for size in args.sizes:
+            file_path = os.path.join(tmp_dir, "Generated%d.asm" % size)
+            generate_program(file_path, size, args.label_ratio, args.variable_ratio, args.seed)
+            programs.append(("generated-%d" % size, file_path))
+
+        for name, file_path in programs:
+            for mode in args.modes:
+                result = _run_isolated(mode, file_path)
+                result["name"] = name
+                results.append(result)
+                print("%-20s %-10s %12.0f lines/sec" % (name, mode, result["lines_per_sec"]), file=sys.stderr)
+
+    report = {
+        "python": sys.version.split()[0],
+        "generator": {
+            "label_ratio": args.label_ratio,
+            "variable_ratio": args.variable_ratio,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            f.write(text + "\n")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.tolerance, args.min_seconds)
+        for regression in regressions:
+            print("regression: %s" % regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+def generate_program(file_path, num_lines, label_ratio, variable_ratio, seed=0):
+    """
+    Write a syntactically valid program of num_lines lines. Labels are
+    declared in order and jumps may target labels before or after them, so
+    both backward and forward references occur.
+    """
+    rng = random.Random(seed)
+    num_labels = max(1, int(num_lines * label_ratio))
+    # only jump to labels early enough in the program for their ROM address
+    # to fit in an A-instruction
+    num_targets = max(1, min(num_labels, int(MAX_TARGET_ADDRESS * label_ratio)))
+    num_variables = max(1, min(num_lines // 200, MAX_VARIABLES))
+    next_label = 0
+    chunk = []
+    with open(file_path, "w") as f:
+        for _ in range(num_lines):
+            r = rng.random()
+            if r < label_ratio and next_label < num_labels:
+                chunk.append("(LABEL_%d)" % next_label)
+                next_label += 1
+            elif r < label_ratio + variable_ratio:
+                chunk.append("@var_%d" % rng.randrange(num_variables))
+            elif r < label_ratio + variable_ratio + 0.1:
+                chunk.append("@LABEL_%d" % rng.randrange(num_targets))
+            elif r < label_ratio + variable_ratio + 0.25:
+                chunk.append("@%d" % rng.randrange(32768))
+            else:
+                chunk.append(rng.choice(C_INSTRUCTIONS))
+            if len(chunk) >= 10000:
+                f.write("\n".join(chunk) + "\n")
+                chunk = []
+        # declare the labels that were referenced but not reached
+        while next_label < num_labels:
+            chunk.append("(LABEL_%d)" % next_label)
+            next_label += 1
+        chunk.append("0;JMP")
+        f.write("\n".join(chunk) + "\n")
+
+
+def compare(baseline, report, tolerance, min_seconds=MIN_COMPARE_SECONDS):
+    """
+    Return a description of every result in report whose lines/sec dropped
+    or whose peak RSS grew by more than tolerance relative to baseline.
+    Lines/sec is only compared when both runs took at least min_seconds.
+    """
+    expected = {(result["name"], result["mode"]): result for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        old = expected.get((result["name"], result["mode"]))
+        if old is None:
+            continue
+        timed = min(result["seconds"], old["seconds"]) >= min_seconds
+        if timed and result["lines_per_sec"] < old["lines_per_sec"] * (1 - tolerance):
+            regressions.append("%s %s: %.0f lines/sec, baseline %.0f" % (
+                result["name"], result["mode"], result["lines_per_sec"], old["lines_per_sec"]))
+        if result["peak_rss"] and old["peak_rss"] and result["peak_rss"] > old["peak_rss"] * (1 + tolerance):
+            regressions.append("%s %s: peak RSS %d bytes, baseline %d" % (
+                result["name"], result["mode"], result["peak_rss"], old["peak_rss"]))
+    return regressions
+
+
+def _run_isolated(mode, file_path):
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), "--run-one", mode, file_path],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    return json.loads(output)
+
+
+def _run_one(mode, file_path):
+    with open(file_path, "r") as f:
+        num_lines = sum(1 for _ in f)
+    hack_assembler = HackAssembler(file_path, use_mmap=mode.endswith("-mmap"))
+    passes = {}
+    with tempfile.TemporaryFile() as dest:
+        writer = HackTextWriter(dest)
+        start = time.perf_counter()
+        with hack_assembler._open_source() as f:
+            if mode in ("two-pass", "two-pass-mmap"):
+                hack_assembler._first_pass(f)
+                passes["first"] = time.perf_counter() - start
+                hack_assembler._second_pass(writer)
+                passes["second"] = time.perf_counter() - start - passes["first"]
+            elif mode == "streaming":
+                hack_assembler.assemble_lines_streaming(f, writer)
+                passes["streaming"] = time.perf_counter() - start
+            else:
+                raise ValueError("unknown mode: %s" % mode)
+        writer.finish()
+        elapsed = time.perf_counter() - start
+    return {
+        "mode": mode,
+        "lines": num_lines,
+        "seconds": elapsed,
+        "lines_per_sec": num_lines / elapsed if elapsed > 0 else 0.0,
+        "pass_seconds": passes,
+        "peak_rss": _peak_rss(),
+    }
+
+
+def _peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+if __name__ == "__main__":
+    main()
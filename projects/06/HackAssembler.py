@@ -1,14 +1,323 @@
+import argparse
+import array
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import glob
+import hashlib
+import io
+import itertools
+import json
+import mmap
+import os
+import re
+import shutil
+import struct
 import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# the largest value an A-instruction can load, bit 15 marks C-instructions
+MAX_ADDRESS = 32767
+
+BACKENDS = ["python", "numpy"]
+
+# Part of every build cache key: bump it whenever the encoded output of
+# the same source can change.
+ASSEMBLER_VERSION = "1.1"
 
 
 def main():
-    file_path = sys.argv[1]
-    hack_assembler = HackAssembler(file_path)
-    hack_assembler.assemble()
+    arg_parser = argparse.ArgumentParser(description="Translate Hack assembly into Hack machine code.")
+    arg_parser.add_argument(
+        "sources",
+        nargs="*",
+        help=".asm files, directories containing .asm files, or glob patterns; - reads stdin and writes stdout",
+    )
+    arg_parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="encode instructions while reading and backpatch forward references at the end",
+    )
+    arg_parser.add_argument(
+        "--format",
+        choices=sorted(OUTPUT_FORMATS),
+        default="hack",
+        help=(
+            "hack: one binary string per line; hackbin: packed little-endian uint16 words; "
+            "hobj: relocatable object for HackLinker.py"
+        ),
+    )
+    arg_parser.add_argument(
+        "--mmap",
+        action="store_true",
+        help="memory-map the source and scan it as bytes instead of reading decoded text lines",
+    )
+    arg_parser.add_argument(
+        "-O",
+        "--optimize",
+        action="store_true",
+        help="remove redundant instructions with a peephole pass before encoding",
+    )
+    arg_parser.add_argument(
+        "--map",
+        action="store_true",
+        help="also write a .map file with label and variable addresses and the source line of every instruction",
+    )
+    arg_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of worker processes used when assembling several files",
+    )
+    arg_parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="python",
+        help="encode the second pass with plain Python or vectorized with NumPy (falls back to python without NumPy)",
+    )
+    arg_parser.add_argument(
+        "--encode-jobs",
+        type=int,
+        default=1,
+        help="encode the second pass of each file in this many worker processes",
+    )
+    arg_parser.add_argument(
+        "--cache-dir",
+        help="reuse outputs of previously assembled sources stored in this directory",
+    )
+    arg_parser.add_argument(
+        "--cache-link",
+        action="store_true",
+        help="hard-link cached outputs instead of copying them",
+    )
+    arg_parser.add_argument(
+        "--prune-cache-size",
+        type=_parse_size,
+        help="shrink the cache below this size (e.g. 500M), dropping least recently used entries first",
+    )
+    arg_parser.add_argument(
+        "--prune-cache-age",
+        type=float,
+        help="drop cache entries not used for this many days",
+    )
+    args = arg_parser.parse_args()
+
+    pruning = args.prune_cache_size is not None or args.prune_cache_age is not None
+    if pruning:
+        if args.cache_dir is None:
+            arg_parser.error("pruning requires --cache-dir")
+        max_age = None if args.prune_cache_age is None else args.prune_cache_age * 24 * 60 * 60
+        removed, freed = BuildCache(args.cache_dir).prune(max_size=args.prune_cache_size, max_age=max_age)
+        print("pruned %d cache entries, %d bytes freed" % (removed, freed))
+    if not args.sources:
+        if pruning:
+            return
+        arg_parser.error("no sources given")
+    if args.map and args.format == "hobj":
+        arg_parser.error("--map cannot be combined with --format hobj")
+
+    if "-" in args.sources:
+        if len(args.sources) > 1:
+            arg_parser.error("- cannot be combined with other sources")
+        if args.map:
+            arg_parser.error("--map needs a source file")
+        _assemble_stdio(args)
+        return
+
+    file_paths = _expand_sources(args.sources)
+    if not file_paths:
+        arg_parser.error("no .asm files found")
+    try:
+        results = assemble_files(
+            file_paths,
+            jobs=args.jobs,
+            output_format=args.format,
+            stream=args.stream,
+            use_mmap=args.mmap,
+            optimize=args.optimize,
+            source_map=args.map,
+            backend=args.backend,
+            encode_jobs=args.encode_jobs,
+            cache_dir=args.cache_dir,
+            cache_link=args.cache_link,
+        )
+    except ValueError as e:
+        arg_parser.error(str(e))
+
+    failures = 0
+    for file_path, dest_file_path, cached, removed, error in results:
+        if error is not None:
+            failures += 1
+            print("%s: error: %s" % (file_path, error), file=sys.stderr)
+            continue
+        notes = []
+        if cached:
+            notes.append("cached")
+        if removed is not None:
+            notes.append("%d instructions removed" % removed)
+        if len(results) > 1 or notes:
+            print("%s -> %s%s" % (file_path, dest_file_path, " (%s)" % ", ".join(notes) if notes else ""))
+    if len(results) > 1:
+        print("%d assembled, %d failed" % (len(results) - failures, failures))
+    if failures:
+        sys.exit(1)
+
+
+def _assemble_stdio(args):
+    """
+    Assemble standard input into standard output. Lines are parsed and
+    encoded as they arrive, so this stage runs alongside the one feeding
+    it. Whether a symbol is a variable is only known at the end of the
+    input, so the encoded program is written out once the input is closed.
+    """
+    hack_assembler = HackAssembler(
+        output_format=args.format,
+        optimize=args.optimize,
+        backend=args.backend,
+    )
+    out = io.BytesIO()
+    try:
+        if args.format == "hobj":
+            HackObjectFile.dump(hack_assembler.assemble_lines_to_object(sys.stdin), out)
+        else:
+            writer = OUTPUT_FORMATS[args.format](out)
+            if args.stream:
+                hack_assembler.assemble_lines_streaming(sys.stdin, writer)
+            else:
+                hack_assembler.assemble_lines(sys.stdin, writer, jobs=args.encode_jobs)
+            writer.finish()
+    except ValueError as e:
+        print("-: error: %s" % e, file=sys.stderr)
+        sys.exit(1)
+    sys.stdout.buffer.write(out.getvalue())
+    sys.stdout.buffer.flush()
+    if args.optimize:
+        print("-: %d instructions removed" % hack_assembler.optimizer.removed, file=sys.stderr)
+
+
+def assemble_files(file_paths, jobs=1, **options):
+    """
+    Assemble every file in file_paths, using a pool of `jobs` worker
+    processes when there is more than one file. The keyword options are
+    output_format, stream, use_mmap, optimize, source_map, backend,
+    encode_jobs, cache_dir and cache_link.
+
+    Return a list of (file_path, dest_file_path, cached, removed, error) in
+    the order of file_paths. removed is the number of instructions the
+    optimizer dropped, None if it did not run; error is None on success and
+    a message otherwise. Raise ValueError if two files would be assembled
+    into the same output.
+    """
+    sources = {}
+    for file_path in file_paths:
+        base_path = os.path.normcase(os.path.abspath(os.path.splitext(file_path)[0]))
+        if base_path in sources:
+            raise ValueError("%s and %s have the same output file" % (sources[base_path], file_path))
+        sources[base_path] = file_path
+    tasks = [(file_path, options) for file_path in file_paths]
+    if jobs <= 1 or len(tasks) <= 1:
+        return [_assemble_file(task) for task in tasks]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(_assemble_file, tasks))
+
+
+def _assemble_file(task):
+    file_path, options = task
+    output_format = options.get("output_format", "hack")
+    optimize = options.get("optimize", False)
+    source_map = options.get("source_map", False)
+    cache_dir = options.get("cache_dir")
+    try:
+        hack_assembler = HackAssembler(
+            file_path,
+            output_format=output_format,
+            optimize=optimize,
+            source_map=source_map,
+            use_mmap=options.get("use_mmap", False),
+            backend=options.get("backend", "python"),
+        )
+        outputs = {"": hack_assembler._dest_file_path}
+        if source_map:
+            outputs[SymbolMap.extension] = hack_assembler._map_file_path
+        if cache_dir is not None:
+            cache = BuildCache(cache_dir)
+            key = cache.key(file_path, output_format, optimize)
+            if all(cache.contains(key + suffix) for suffix in outputs):
+                for suffix, output_path in outputs.items():
+                    cache.fetch(key + suffix, output_path, link=options.get("cache_link", False))
+                return file_path, outputs[""], True, None, None
+        if options.get("stream", False):
+            hack_assembler.assemble_streaming()
+        else:
+            hack_assembler.assemble(jobs=options.get("encode_jobs", 1))
+        if cache_dir is not None:
+            for suffix, output_path in outputs.items():
+                cache.store(key + suffix, output_path)
+    except (OSError, ValueError) as e:
+        return file_path, None, False, None, str(e)
+    removed = hack_assembler.optimizer.removed if optimize else None
+    return file_path, outputs[""], False, removed, None
+
+
+def _parse_size(text):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    text = text.strip().upper()
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+@contextlib.contextmanager
+def _replaced_file(file_path, mode):
+    """
+    Open a temporary file next to file_path and move it over file_path once
+    the block succeeds. An output fetched with --cache-link is a hard link
+    into the build cache, and writing it in place would change the entry.
+    """
+    tmp_path = "%s.%d.tmp" % (file_path, os.getpid())
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _expand_sources(sources):
+    """
+    Turn the command line sources into a list of .asm files: directories
+    contribute their .asm files and glob patterns their matches, both in
+    sorted order. Duplicates are dropped.
+    """
+    file_paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            file_paths.extend(sorted(glob.glob(os.path.join(source, "*.asm"))))
+        elif glob.has_magic(source):
+            file_paths.extend(sorted(glob.glob(source, recursive=True)))
+        else:
+            file_paths.append(source)
+    unique_paths = {}
+    for file_path in file_paths:
+        unique_paths.setdefault(os.path.normcase(os.path.abspath(file_path)), file_path)
+    return list(unique_paths.values())
 
 
 class HackAssembler:
     VARIABLE_START_ADDRESS = 16
+    # number of encoded instructions buffered before they are handed to the writer
+    CHUNK_SIZE = 4096
+    # number of lines encoded by one task of a parallel second pass
+    PARALLEL_CHUNK_SIZE = 65536
     DEFAULT_SYMBOL_TABLE = {
         "R0": 0, 
         "R1": 1, 
@@ -35,48 +344,894 @@ class HackAssembler:
         "THAT": 4,
     }
 
-    def __init__(self, file_path):
+    def __init__(
+        self,
+        file_path=None,
+        output_format="hack",
+        optimize=False,
+        source_map=False,
+        use_mmap=False,
+        backend="python",
+    ):
+        if backend not in BACKENDS:
+            raise ValueError("unknown backend: %s" % backend)
+        if source_map and output_format == "hobj":
+            # variables and labels only get their final addresses when linking
+            raise ValueError("no symbol map for object files")
         self._file_path = file_path
-        self._dest_file_path = self._file_path.split(".")[0] + ".hack"
+        self._use_mmap = use_mmap
+        self._backend = backend
+        self._writer_class = OUTPUT_FORMATS[output_format]
+        if file_path is not None:
+            base_path = os.path.splitext(self._file_path)[0]
+            self._dest_file_path = base_path + self._writer_class.extension
+            self._map_file_path = base_path + SymbolMap.extension
 
         self._symbol_table = {}
         self._symbol_table.update(self.DEFAULT_SYMBOL_TABLE)
         self._lines = []
         self._variable_address = self.VARIABLE_START_ADDRESS
+        self.optimizer = PeepholeOptimizer() if optimize else None
+        self._variables = []
+        # source line of every instruction, only kept for the symbol map
+        self._line_numbers = array.array("L") if source_map else None
+
+    def assemble(self, jobs=1):
+        with self._open_source() as f:
+            self._first_pass(f)
+        with _replaced_file(self._dest_file_path, "wb") as f:
+            if self._writer_class is HackObjectFile:
+                HackObjectFile.dump(self._object(), f)
+                return
+            writer = self._writer_class(f)
+            self._encode(writer, jobs)
+            writer.finish()
+        self._write_symbol_map()
+
+    def assemble_streaming(self):
+        if self._writer_class is HackObjectFile:
+            # an object file is only written once all labels are known
+            self.assemble()
+            return
+        with self._open_source() as src, _replaced_file(self._dest_file_path, "wb") as dest:
+            writer = self._writer_class(dest)
+            self.assemble_lines_streaming(src, writer)
+            writer.finish()
+        self._write_symbol_map()
+
+    def _open_source(self):
+        if self._use_mmap:
+            return MappedSourceFile(self._file_path)
+        return open(self._file_path, "r")
 
-    def assemble(self):
+    def _write_symbol_map(self):
+        if self._line_numbers is not None:
+            with _replaced_file(self._map_file_path, "w") as f:
+                self.symbol_map().dump(f)
+
+    def symbol_map(self):
+        """
+        Return the SymbolMap of the program assembled last. Only available
+        when the assembler was created with source_map=True.
+        """
+        variables = set(self._variables)
+        labels = []
+        for symbol, address in self._symbol_table.items():
+            if symbol not in variables and self.DEFAULT_SYMBOL_TABLE.get(symbol) != address:
+                labels.append((address, symbol))
+        return SymbolMap(
+            sorted(labels),
+            [(self._symbol_table[symbol], symbol) for symbol in self._variables],
+            SymbolMap.line_runs(self._line_numbers),
+            len(self._line_numbers),
+        )
+
+    def assemble_lines(self, lines, writer, jobs=1):
+        """
+        Assemble an iterable of source lines with two passes and hand the
+        encoded instructions to writer. With jobs > 1 the second pass runs
+        in that many worker processes.
+        """
+        self._first_pass(lines)
+        self._encode(writer, jobs)
+
+    def assemble_lines_to_object(self, lines):
+        """
+        Assemble an iterable of source lines into a relocatable object, see
+        HackObjectFile.
+        """
+        self._first_pass(lines)
+        return self._object()
+
+    def _first_pass(self, lines):
         next_line_number = 0
-        with open(self._file_path, "r") as f:
+        line_numbers = self._line_numbers
+        for line in self._read_instructions(lines):
+            if line.startswith("(") and line.endswith(")"):
+                self._symbol_table[line[1:-1]] = next_line_number
+            else:
+                self._lines.append(line)
+                if line_numbers is not None:
+                    line_numbers.append(line.line_number)
+                next_line_number += 1
+
+    def _encode(self, writer, jobs):
+        if self._backend == "numpy" and np is not None:
+            self._second_pass_vectorized(writer)
+        elif jobs > 1:
+            self._second_pass_parallel(writer, jobs)
+        else:
+            self._second_pass(writer)
+
+    def _second_pass(self, writer):
+        chunk = []
+        resolve = self._resolve_symbol
+        for line in self._lines:
+            chunk.append(_encode_line(line, resolve))
+            if len(chunk) >= self.CHUNK_SIZE:
+                writer.write(chunk)
+                chunk = []
+        writer.write(chunk)
+
+    def _object(self):
+        """
+        Encode the lines of the first pass as a relocatable object. Numbers
+        and predefined symbols are encoded right away; every other symbol
+        may be a label of this module, a label of another module or a
+        variable, so its word is left 0 and recorded as a relocation.
+        """
+        labels = {}
+        for symbol, address in self._symbol_table.items():
+            if self.DEFAULT_SYMBOL_TABLE.get(symbol) != address:
+                labels[symbol] = address
+
+        code = []
+        relocations = []
+
+        def resolve(symbol):
+            if symbol in self.DEFAULT_SYMBOL_TABLE and symbol not in labels:
+                return self.DEFAULT_SYMBOL_TABLE[symbol]
+            relocations.append([len(code), symbol])
+            return 0
+
+        for line in self._lines:
+            code.append(_encode_line(line, resolve))
+        return {
+            "format": HackObjectFile.format,
+            "version": HackObjectFile.version,
+            "code": code,
+            "labels": labels,
+            "relocations": relocations,
+        }
+
+    def _second_pass_vectorized(self, writer):
+        """
+        NumPy second pass. Every line is mapped to the index of its first
+        occurrence among the distinct lines in one C-level sweep; generated
+        code repeats a few shapes, so only those distinct lines are encoded
+        one by one. Encoding them in first-occurrence order hands out
+        variable addresses in first-use order, exactly like _second_pass().
+        Gathering the values by index gives the program as one uint16
+        array, which the writer renders chunk by chunk with array
+        operations.
+        """
+        distinct = collections.defaultdict(itertools.count().__next__)
+        line_ids = np.fromiter(map(distinct.__getitem__, self._lines), dtype=np.intp, count=len(self._lines))
+        values = [_encode_line(line, self._resolve_symbol) for line in distinct]
+        words = np.array(values, dtype=np.uint16)[line_ids]
+        for start in range(0, len(words), self.PARALLEL_CHUNK_SIZE):
+            chunk = words[start:start + self.PARALLEL_CHUNK_SIZE]
+            writer.write_serialized(writer.serialize_array(chunk), len(chunk))
+
+    def _second_pass_parallel(self, writer, jobs):
+        """
+        Once the labels are known, the only order dependent part of the
+        second pass is handing out variable addresses in first-use order.
+        A cheap scan does that up front; after it every line encodes on its
+        own, so chunks of PARALLEL_CHUNK_SIZE lines are encoded and
+        serialized in worker processes and written back in order. The
+        result is byte-identical to _second_pass().
+        """
+        for line in self._lines:
+            if line.startswith("@"):
+                symbol = line[1:]
+                if not symbol.isdigit():
+                    self._resolve_symbol(symbol)
+
+        tasks = []
+        for start in range(0, len(self._lines), self.PARALLEL_CHUNK_SIZE):
+            tasks.append((self._lines[start:start + self.PARALLEL_CHUNK_SIZE], type(writer)))
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_encoder,
+            initargs=(self._symbol_table,),
+        ) as executor:
+            for data, count in executor.map(_encode_chunk, tasks):
+                writer.write_serialized(data, count)
+
+    def assemble_lines_streaming(self, lines, writer):
+        """
+        Single pass: every instruction is encoded as soon as it is read and
+        written out in chunks of CHUNK_SIZE. An A-instruction whose symbol is
+        not known yet (a label defined further down, or a variable) is written
+        as a placeholder and its address is added to the forward references
+        of the symbol. After the last line every forward reference is
+        resolved, in first-use order so that variables get the same addresses
+        as in assemble(), and the placeholders are overwritten in place by the
+        writer.
+
+        Memory does not grow with the program itself, only with the number
+        of references to variables and forward labels, at 4 bytes each.
+        """
+        forward_references = {}  # symbol -> array of instruction addresses
+        chunk = []
+        next_line_number = 0
+        line_numbers = self._line_numbers
+        symbol_table = self._symbol_table
+
+        def resolve(symbol):
+            value = symbol_table.get(symbol)
+            if value is not None:
+                return value
+            addresses = forward_references.get(symbol)
+            if addresses is None:
+                addresses = forward_references[symbol] = array.array("L")
+            addresses.append(next_line_number)
+            return 0
+
+        for line in self._read_instructions(lines):
+            if line.startswith("(") and line.endswith(")"):
+                symbol_table[line[1:-1]] = next_line_number
+                continue
+            if line_numbers is not None:
+                line_numbers.append(line.line_number)
+            chunk.append(_encode_line(line, resolve))
+            next_line_number += 1
+            if len(chunk) >= self.CHUNK_SIZE:
+                writer.write(chunk)
+                chunk = []
+        writer.write(chunk)
+
+        for symbol in list(forward_references):
+            value = _encode_line("@" + symbol, self._resolve_symbol)
+            writer.patch_all(forward_references.pop(symbol), value)
+
+    def _read_instructions(self, f):
+        """
+        Yield every instruction and label declaration of the source with
+        whitespace and comments removed, run through the optimizer if there
+        is one.
+        """
+        if self.optimizer is not None:
+            return self.optimizer.optimize(self._read_source(f))
+        return self._read_source(f)
+
+    def _read_source(self, f):
+        numbered = self._line_numbers is not None
+        if isinstance(f, MappedSourceFile):
+            yield from f.instructions(numbered)
+            return
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if line == "":
+                continue
+            elif line.startswith("//"):
+                continue
+            elif numbered:
+                yield SourceLine(line.split("//")[0].strip(), line_number)
+            else:
+                yield line.split("//")[0].strip()
+
+    def _resolve_symbol(self, symbol):
+        if symbol not in self._symbol_table:
+            self._symbol_table[symbol] = self._variable_address
+            self._variables.append(symbol)
+            self._variable_address += 1
+        return self._symbol_table[symbol]
+
+
+class MappedSourceFile:
+    """
+    A memory-mapped .asm file that is cleaned in blocks of about block_size
+    bytes, always cut right after a newline. Comments are cut out of a
+    block by one bytes substitution, then the block is decoded at once and
+    split, stripped and filtered by C-level builtins, so there is no Python
+    code run per line and no per-line decoding. Gives the same instructions
+    as the text path.
+    """
+    block_size = 1 << 20
+    comment_pattern = re.compile(rb"//[^\n]*")
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = open(self.file_path, "rb")
+        if os.fstat(self.file.fileno()).st_size == 0:
+            # an empty file cannot be mapped
+            self.map = None
+        else:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _blocks(self):
+        start = 0
+        size = len(self.map)
+        while start < size:
+            end = self.map.find(b"\n", min(start + self.block_size, size) - 1) + 1 or size
+            yield self.map[start:end]
+            start = end
+
+    def instructions(self, numbered=False):
+        if self.map is None:
+            return
+        line_number = 1
+        for block in self._blocks():
+            if b"//" in block:
+                block = self.comment_pattern.sub(b"", block)
+            lines = block.decode("utf-8").split("\n")
+            if not numbered:
+                yield from filter(None, map(str.strip, lines))
+                continue
+            for i, line in enumerate(map(str.strip, lines), line_number):
+                if line:
+                    yield SourceLine(line, i)
+            line_number += len(lines) - 1
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+
+class SourceLine(str):
+    """
+    A cleaned source line that remembers its line number in the .asm file.
+    Only used when a symbol map is requested.
+    """
+
+    def __new__(cls, text, line_number):
+        line = str.__new__(cls, text)
+        line.line_number = line_number
+        return line
+
+    def __reduce__(self):
+        # str pickles only its text, which __new__ can't take alone
+        return (SourceLine, (str(self), self.line_number))
+
+
+class SymbolMap:
+    """
+    The .map sidecar of a program. After the header comes the number of
+    instructions, then sections sorted by address, so profilers and
+    emulators can bisect them:
+
+        instructions    <number of instructions>
+        [labels]        <ROM address> <label>
+        [variables]     <RAM address> <variable>
+        [lines]         <ROM address> <source line>
+
+    The lines section only lists the instructions that do not directly
+    follow the source line of the previous instruction; every other
+    instruction sits that many lines below the closest entry before it.
+    """
+    extension = ".map"
+    header = "# hack symbol map 1"
+
+    def __init__(self, labels, variables, lines, size):
+        self.labels = labels
+        self.variables = variables
+        self.lines = lines
+        self.size = size
+        self._label_addresses = [address for address, _ in labels]
+        self._line_addresses = [address for address, _ in lines]
+
+    @staticmethod
+    def line_runs(line_numbers):
+        runs = []
+        previous = None
+        for address, line_number in enumerate(line_numbers):
+            if previous is None or line_number != previous + 1:
+                runs.append((address, line_number))
+            previous = line_number
+        return runs
+
+    def dump(self, f):
+        f.write(self.header + "\n")
+        f.write("instructions %d\n" % self.size)
+        for section, entries in (("labels", self.labels), ("variables", self.variables), ("lines", self.lines)):
+            f.write("[%s]\n" % section)
+            f.write("".join("%d %s\n" % entry for entry in entries))
+
+    @classmethod
+    def load(cls, file_path):
+        sections = {"labels": [], "variables": [], "lines": []}
+        with open(file_path, "r") as f:
+            if f.readline().rstrip("\n") != cls.header:
+                raise ValueError("not a symbol map: %s" % file_path)
+            field, size = f.readline().split()
+            if field != "instructions":
+                raise ValueError("not a symbol map: %s" % file_path)
+            entries = None
             for line in f:
-                line = line.strip()
-                if line == "":
-                    continue
-                elif line.startswith("//"):
-                    continue
+                line = line.rstrip("\n")
+                if line.startswith("["):
+                    entries = sections[line[1:-1]]
                 else:
-                    line = line.split("//")[0].strip()
-                    if line.startswith("(") and line.endswith(")"):
-                        self._symbol_table[line[1:-1]] = next_line_number
-                    else:
-                        self._lines.append(line)
-                        next_line_number += 1
-
-        with open(self._dest_file_path, "w") as f:
-            for line in self._lines:
-                if line.startswith("@"):
-                    symbol = line[1:]
-                    if symbol.isdigit():
-                        value = int(symbol)
-                    else:
-                        if symbol not in self._symbol_table:
-                            self._symbol_table[symbol] = self._variable_address
-                            self._variable_address += 1
-                        value = self._symbol_table[symbol]
-                    # @value -> 0vvv vvvv vvvv vvvv
-                    code = "{0:016b}".format(value)
+                    address, value = line.split(" ", 1)
+                    entries.append((int(address), value))
+        lines = [(address, int(line_number)) for address, line_number in sections["lines"]]
+        return cls(sections["labels"], sections["variables"], lines, int(size))
+
+    def label_at(self, address):
+        """
+        Return the closest label at or before ROM address, or None.
+        """
+        i = bisect.bisect_right(self._label_addresses, address)
+        return self.labels[i - 1][1] if i > 0 else None
+
+    def source_line(self, address):
+        """
+        Return the .asm line number of the instruction at ROM address.
+        """
+        i = bisect.bisect_right(self._line_addresses, address)
+        if i == 0 or address >= self.size:
+            raise ValueError("no instruction at address %d" % address)
+        start, line_number = self.lines[i - 1]
+        return line_number + address - start
+
+
+class PeepholeOptimizer:
+    """
+    Rewrite redundant instruction sequences of the cleaned source before
+    it is encoded:
+
+    @X / @Y             -> @Y           the first load is dead
+    @X / C / @X         -> @X / C       when C does not write A
+    M=M+1 / M=M-1       -> (nothing)    and the other way around
+    @L / J / (L)        -> (L)          a dest-less jump to the very next
+                                        instruction, if an A-instruction
+                                        follows so the A it set is unused
+
+    A rewrite never spans a label declaration except for the last rule,
+    which keeps the label, so every label still addresses the same code.
+    The pending instructions live on a stack of at most `window` entries;
+    a rewrite can expose another one further down, which is why rules are
+    retried until none applies. `removed` counts the dropped instructions.
+    """
+    window = 32
+
+    def __init__(self):
+        self.removed = 0
+
+    def optimize(self, lines):
+        pending = collections.deque()
+        for line in lines:
+            if line.startswith("("):
+                pending.append(line)
+            elif line.startswith("@"):
+                self._reduce_before_load(pending)
+                if (len(pending) >= 2 and pending[-2] == line
+                        and not self._is_label(pending[-1]) and not self._writes_a(pending[-1])
+                        and not pending[-1].startswith("@")):
+                    self.removed += 1
                 else:
-                    code = CInstruction(line).code()
-                f.write(code + "\n")
+                    pending.append(line)
+            else:
+                pending.append(line)
+                if len(pending) >= 2 and {pending[-2], pending[-1]} == {"M=M+1", "M=M-1"}:
+                    pending.pop()
+                    pending.pop()
+                    self.removed += 2
+            while len(pending) > self.window:
+                yield pending.popleft()
+        self._reduce_before_load(pending)
+        yield from pending
+
+    def _reduce_before_load(self, pending):
+        """
+        Apply the rules that only hold because an A-instruction follows.
+        """
+        while pending:
+            if pending[-1].startswith("@"):
+                pending.pop()
+                self.removed += 1
+                continue
+            labels = set()
+            i = len(pending) - 1
+            while i >= 0 and self._is_label(pending[i]):
+                labels.add(pending[i][1:-1])
+                i -= 1
+            if (labels and i >= 1 and self._is_jump(pending[i])
+                    and pending[i - 1].startswith("@") and pending[i - 1][1:] in labels):
+                del pending[i]
+                del pending[i - 1]
+                self.removed += 2
+                continue
+            break
+
+    @staticmethod
+    def _is_label(line):
+        return line.startswith("(")
+
+    @staticmethod
+    def _writes_a(line):
+        return "=" in line and "A" in line.split("=")[0]
+
+    @staticmethod
+    def _is_jump(line):
+        return ";" in line and "=" not in line
+
+
+def _encode_line(line, resolve):
+    """
+    Return the 16-bit word of a cleaned instruction. resolve is called with
+    the symbol of an A-instruction and returns its value. A-instruction
+    values above MAX_ADDRESS would be read as C-instructions, so they are
+    rejected.
+    """
+    if line.startswith("@"):
+        symbol = line[1:]
+        value = int(symbol) if symbol.isdigit() else resolve(symbol)
+        if value > MAX_ADDRESS:
+            raise ValueError("address out of range: %s = %d" % (line, value))
+        return value
+    value = C_INSTRUCTION_TABLE.get(line)
+    if value is None:
+        value = CInstruction.encode(line)
+    return value
+
+
+_encoder_symbol_table = None
+
+
+def _init_encoder(symbol_table):
+    global _encoder_symbol_table
+    _encoder_symbol_table = symbol_table
+
+
+def _encode_chunk(task):
+    """
+    Encode lines whose symbols are all in the worker's symbol table and
+    return them serialized by writer_class, with the instruction count.
+    """
+    lines, writer_class = task
+    resolve = _encoder_symbol_table.__getitem__
+    values = [_encode_line(line, resolve) for line in lines]
+    return writer_class.serialize(values), len(values)
+
+
+class BuildCache:
+    """
+    On-disk cache of assembled outputs. An entry is keyed by the SHA-256 of
+    the source contents, the output format, whether the optimizer ran and
+    ASSEMBLER_VERSION, and lives
+    at <cache_dir>/<key[:2]>/<key><extension>. The modification time of an
+    entry is refreshed on every hit, so pruning drops the least recently
+    used entries first.
+    """
+    read_size = 1 << 20
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def key(self, file_path, output_format, optimize=False):
+        digest = hashlib.sha256()
+        digest.update(("%s\0%s\0%d\0" % (ASSEMBLER_VERSION, output_format, optimize)).encode("ascii"))
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(self.read_size), b""):
+                digest.update(block)
+        return digest.hexdigest() + OUTPUT_FORMATS[output_format].extension
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def contains(self, key):
+        return os.path.exists(self._entry_path(key))
+
+    def fetch(self, key, dest_file_path, link=False):
+        """
+        Put the cached output for key at dest_file_path. Return False when
+        there is no such entry.
+        """
+        entry_path = self._entry_path(key)
+        if not os.path.exists(entry_path):
+            return False
+        if os.path.exists(dest_file_path):
+            os.remove(dest_file_path)
+        if link:
+            try:
+                os.link(entry_path, dest_file_path)
+            except OSError:
+                shutil.copyfile(entry_path, dest_file_path)
+        else:
+            shutil.copyfile(entry_path, dest_file_path)
+        os.utime(entry_path)
+        return True
+
+    def store(self, key, file_path):
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        # copy next to the entry first so that readers never see a partial file
+        tmp_path = "%s.%d.tmp" % (entry_path, os.getpid())
+        shutil.copyfile(file_path, tmp_path)
+        os.replace(tmp_path, entry_path)
+
+    def prune(self, max_size=None, max_age=None):
+        """
+        Remove entries unused for more than max_age seconds, then the least
+        recently used ones until the cache holds at most max_size bytes.
+        Return (number of removed entries, number of freed bytes).
+        """
+        entries = []
+        for dir_path, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                entry_path = os.path.join(dir_path, file_name)
+                st = os.stat(entry_path)
+                entries.append((st.st_mtime, st.st_size, entry_path))
+        entries.sort()
+
+        now = time.time()
+        total_size = sum(size for _, size, _ in entries)
+        removed = 0
+        freed = 0
+        for mtime, size, entry_path in entries:
+            too_old = max_age is not None and now - mtime > max_age
+            too_big = max_size is not None and total_size > max_size
+            if not too_old and not too_big:
+                continue
+            os.remove(entry_path)
+            total_size -= size
+            removed += 1
+            freed += size
+        return removed, freed
+
+
+class HackTextWriter:
+    """
+    The .hack text format: one instruction per line written as 16 ASCII
+    "0"/"1" characters. Every line takes exactly 17 bytes, so instruction n
+    starts n * 17 bytes after where the file was when the writer was made.
+
+    Writers encode into a binary file object that the caller opens and
+    closes.
+    """
+    extension = ".hack"
+    line_width = 17
+
+    def __init__(self, file):
+        self.file = file
+        self._start = self.file.tell()
+
+    @staticmethod
+    def serialize(values):
+        return "".join(map("{0:016b}\n".format, values)).encode("ascii")
+
+    @staticmethod
+    def serialize_array(words):
+        """
+        serialize() for a NumPy uint16 array: the big-endian bits of every
+        word become the ASCII digits of one row, followed by a newline.
+        """
+        bits = np.unpackbits(words.astype(">u2").view(np.uint8).reshape(-1, 2), axis=1)
+        text = np.empty((len(words), 17), dtype=np.uint8)
+        text[:, :16] = bits + ord("0")
+        text[:, 16] = ord("\n")
+        return text.tobytes()
+
+    def write(self, values):
+        self.file.write(self.serialize(values))
+
+    def write_serialized(self, data, count):
+        self.file.write(data)
+
+    def patch_all(self, addresses, value):
+        data = "{0:016b}\n".format(value).encode("ascii")
+        start = self._start
+        _write_at(self.file, (start + address * self.line_width for address in addresses), data)
+
+    def finish(self):
+        pass
+
+
+class HackBinaryWriter:
+    """
+    The .hackbin format: a 12 byte header followed by the instructions as a
+    packed array of little-endian uint16 words.
+
+    header: magic b"HACK" | version uint16 | header size uint16 | instruction count uint32
+    """
+    extension = ".hackbin"
+    magic = b"HACK"
+    version = 1
+    header = struct.Struct("<4sHHI")
+
+    def __init__(self, file):
+        self.file = file
+        self._start = self.file.tell()
+        self._count = 0
+        self._write_header()
+
+    def _write_header(self):
+        self.file.write(self.header.pack(self.magic, self.version, self.header.size, self._count))
+
+    @staticmethod
+    def serialize(values):
+        words = array.array("H", values)
+        if sys.byteorder == "big":
+            words.byteswap()
+        return words.tobytes()
+
+    @staticmethod
+    def serialize_array(words):
+        return words.astype("<u2").tobytes()
+
+    def write(self, values):
+        self.write_serialized(self.serialize(values), len(values))
+
+    def write_serialized(self, data, count):
+        self.file.write(data)
+        self._count += count
+
+    def patch_all(self, addresses, value):
+        start = self._start + self.header.size
+        _write_at(self.file, (start + address * 2 for address in addresses), struct.pack("<H", value))
+
+    def finish(self):
+        end = self.file.tell()
+        self.file.seek(self._start)
+        self._write_header()
+        self.file.seek(end)
+
+
+class WordWriter:
+    """
+    Collect the encoded instructions in memory as an array of uint16.
+    serialize() uses the native byte order of that array.
+    """
+
+    def __init__(self):
+        self.words = array.array("H")
+
+    @staticmethod
+    def serialize(values):
+        return array.array("H", values).tobytes()
+
+    @staticmethod
+    def serialize_array(words):
+        return words.astype(np.uint16).tobytes()
+
+    def write(self, values):
+        self.words.extend(values)
+
+    def write_serialized(self, data, count):
+        self.words.frombytes(data)
+
+    def patch_all(self, addresses, value):
+        words = self.words
+        for address in addresses:
+            words[address] = value
+
+    def finish(self):
+        pass
+
+
+def _write_at(file, offsets, data):
+    """
+    Overwrite data at every offset of file and keep its position. Files on
+    disk are written with os.pwrite, one system call per offset; other file
+    objects are seeked.
+    """
+    file.flush()
+    try:
+        fileno = file.fileno() if hasattr(os, "pwrite") else None
+    except (AttributeError, io.UnsupportedOperation):
+        fileno = None
+    if fileno is not None:
+        for offset in offsets:
+            os.pwrite(fileno, data, offset)
+        return
+    end = file.tell()
+    for offset in offsets:
+        file.seek(offset)
+        file.write(data)
+    file.seek(end)
+
+
+def read_hack_binary(file_path):
+    """
+    Load a .hackbin file and return its instructions as an array of uint16.
+    """
+    with open(file_path, "rb") as f:
+        data = f.read()
+    magic, version, header_size, count = HackBinaryWriter.header.unpack_from(data)
+    if magic != HackBinaryWriter.magic:
+        raise ValueError("not a hackbin file: %s" % file_path)
+    if version != HackBinaryWriter.version:
+        raise ValueError("unsupported hackbin version: %d" % version)
+    words = array.array("H")
+    words.frombytes(data[header_size:header_size + count * 2])
+    if sys.byteorder == "big":
+        words.byteswap()
+    return words
+
+
+class HackObjectFile:
+    """
+    The .hobj relocatable object format, a JSON document with
+
+    code: the module's instructions, addressed from 0
+    labels: {label: address within the module}
+    relocations: [[address within the module, symbol], ...] in first-use
+        order; the word at that address is 0 and gets the symbol's final
+        value when HackLinker.py resolves it to a label of any module or,
+        failing that, to a variable
+    """
+    extension = ".hobj"
+    format = "hobj"
+    version = 1
+
+    @classmethod
+    def dump(cls, obj, f):
+        f.write(json.dumps(obj, separators=(",", ":")).encode("utf-8"))
+
+    @classmethod
+    def load(cls, file_path):
+        with open(file_path, "rb") as f:
+            obj = json.loads(f.read().decode("utf-8"))
+        if obj.get("format") != cls.format:
+            raise ValueError("not a hobj file: %s" % file_path)
+        if obj.get("version") != cls.version:
+            raise ValueError("unsupported hobj version: %s" % obj.get("version"))
+        return obj
+
+
+OUTPUT_FORMATS = {
+    "hack": HackTextWriter,
+    "hackbin": HackBinaryWriter,
+    "hobj": HackObjectFile,
+}
+
+
+def assemble_words(source, streaming=False):
+    """
+    Assemble source, an iterable of lines or a single string, without
+    touching the filesystem and return the program as an array of uint16.
+    """
+    writer = WordWriter()
+    _assemble_source(source, writer, streaming)
+    return writer.words
+
+
+def assemble_bytes(source, output_format="hack", streaming=False):
+    """
+    Assemble source, an iterable of lines or a single string, and return the
+    contents the file of the given output format would have.
+    """
+    f = io.BytesIO()
+    if OUTPUT_FORMATS[output_format] is HackObjectFile:
+        if isinstance(source, str):
+            source = source.splitlines()
+        # an object file is only written once all labels are known
+        HackObjectFile.dump(HackAssembler().assemble_lines_to_object(source), f)
+        return f.getvalue()
+    writer = OUTPUT_FORMATS[output_format](f)
+    _assemble_source(source, writer, streaming)
+    return f.getvalue()
+
+
+def _assemble_source(source, writer, streaming):
+    if isinstance(source, str):
+        source = source.splitlines()
+    hack_assembler = HackAssembler()
+    if streaming:
+        hack_assembler.assemble_lines_streaming(source, writer)
+    else:
+        hack_assembler.assemble_lines(source, writer)
+    writer.finish()
 
 
 class CInstruction:
@@ -136,30 +1291,39 @@ class CInstruction:
         "JMP": "111",
     }
 
-    def __init__(self, instruction):
-        self.comp, self.dest, self.jump = self._parse(instruction)
+    @staticmethod
+    def encode(instruction):
+        """
+        Return the 16-bit value of a C-instruction using C_INSTRUCTION_TABLE.
+        Whitespace inside the instruction ("D = M ; JGT") is ignored.
+        """
+        value = C_INSTRUCTION_TABLE.get(instruction)
+        if value is None:
+            value = C_INSTRUCTION_TABLE.get("".join(instruction.split()))
+            if value is None:
+                raise ValueError("invalid instruction: %s" % instruction)
+        return value
 
-    def _parse(self, instruction):
-        comp = None
-        dest = "null"
-        jump = "null"
-        if ";" in instruction:
-            left, right = instruction.split(";")
-            jump = right
-        else:
-            left = instruction
-        if "=" in left:
-            dest, comp = left.split("=")
-        else:
-            comp = left
-        return comp.strip(), dest.strip(), jump.strip()
-
-    def code(self):
-        return self.code_template.format(
-            comp=self.comp_table[self.comp],       
-            dest=self.dest_table[self.dest],
-            jump=self.jump_table[self.jump]
-        )
+
+def _build_c_instruction_table():
+    """
+    Map every valid dest=comp;jump spelling to its 16-bit value. Both the
+    omitted and the explicit "null" forms of dest and jump are included.
+    """
+    table = {}
+    for comp, comp_code in CInstruction.comp_table.items():
+        for dest, dest_code in CInstruction.dest_table.items():
+            for jump, jump_code in CInstruction.jump_table.items():
+                value = int(CInstruction.code_template.format(comp=comp_code, dest=dest_code, jump=jump_code), 2)
+                dest_spellings = ["", "null="] if dest == "null" else [dest + "="]
+                jump_spellings = ["", ";null"] if jump == "null" else [";" + jump]
+                for dest_spelling in dest_spellings:
+                    for jump_spelling in jump_spellings:
+                        table[dest_spelling + comp + jump_spelling] = value
+    return table
+
+
+C_INSTRUCTION_TABLE = _build_c_instruction_table()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,80 @@
+import argparse
+import itertools
+import sys
+
+from HackAssembler import OUTPUT_FORMATS, HackAssembler, HackObjectFile, _encode_line
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Link relocatable .hobj modules into one Hack program.")
+    arg_parser.add_argument("objects", nargs="+", help=".hobj files, in the order they are placed in ROM")
+    arg_parser.add_argument("-o", "--output", required=True, help="the program to write")
+    arg_parser.add_argument(
+        "--format",
+        choices=["hack", "hackbin"],
+        default="hack",
+        help="hack: one binary string per line; hackbin: packed little-endian uint16 words",
+    )
+    args = arg_parser.parse_args()
+
+    linker = HackLinker()
+    try:
+        for file_path in args.objects:
+            linker.add_object(file_path)
+        with open(args.output, "wb") as f:
+            writer = OUTPUT_FORMATS[args.format](f)
+            linker.link(writer)
+            writer.finish()
+    except (OSError, ValueError) as e:
+        print("error: %s" % e, file=sys.stderr)
+        sys.exit(1)
+
+
+class HackLinker:
+    """
+    Place modules one after another in ROM, starting at address 0, and
+    resolve their relocations. A symbol is a label if any module defines it
+    and a variable otherwise. Variables are allocated in first-use order
+    over the modules in link order, so linking the objects of consecutive
+    pieces of a program gives the same result as assembling it whole.
+    """
+
+    def __init__(self):
+        self._modules = []
+
+    def add_object(self, file_path):
+        self._modules.append((file_path, HackObjectFile.load(file_path)))
+
+    def add_module(self, name, obj):
+        self._modules.append((name, obj))
+
+    def link(self, writer):
+        labels = {}
+        defined_in = {}
+        base = 0
+        for name, obj in self._modules:
+            for label, address in obj["labels"].items():
+                if label in labels:
+                    raise ValueError("label %s defined in both %s and %s" % (label, defined_in[label], name))
+                labels[label] = base + address
+                defined_in[label] = name
+            base += len(obj["code"])
+
+        symbol_table = dict(HackAssembler.DEFAULT_SYMBOL_TABLE)
+        symbol_table.update(labels)
+        variable_addresses = itertools.count(HackAssembler.VARIABLE_START_ADDRESS)
+
+        def resolve(symbol):
+            if symbol not in symbol_table:
+                symbol_table[symbol] = next(variable_addresses)
+            return symbol_table[symbol]
+
+        for name, obj in self._modules:
+            code = list(obj["code"])
+            for address, symbol in obj["relocations"]:
+                code[address] = _encode_line("@" + symbol, resolve)
+            writer.write(code)
+
+
+if __name__ == "__main__":
+    main()
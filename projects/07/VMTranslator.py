@@ -1,25 +1,42 @@
+import argparse
 import os
 import sys
 
 
 def main():
-    src_file_path = sys.argv[1]
+    arg_parser = argparse.ArgumentParser(description="Translate a .vm file into Hack assembly.")
+    arg_parser.add_argument("src_file", help="the .vm file to translate; - reads stdin and writes stdout")
+    arg_parser.add_argument(
+        "--name",
+        default="Stdin",
+        help="file name used for static variables when reading stdin",
+    )
+    args = arg_parser.parse_args()
+
+    src_file_path = args.src_file
+    if src_file_path == "-":
+        _translate(sys.stdin, "-", args.name)
+        return
     src_file_dir = os.path.dirname(src_file_path)
     src_file_name = os.path.basename(src_file_path)  # xxx.vm
     dest_file_path = os.path.join(src_file_dir, "%s.asm" % src_file_name[:-3])
     with open(src_file_path, "r") as f:
-        parser = Parser(f)
-        writer = CodeWriter(dest_file_path)
-        writer.set_file_name(src_file_name[:-3])
-        while parser.has_more_commands():
-            parser.advance()
-            if parser.command_type() == CommandType.C_ARITHMETIC:
-                writer.write_arithmetic(parser.arg1())
-            elif parser.command_type() == CommandType.C_PUSH:
-                writer.write_push(parser.arg1(), parser.arg2())
-            elif parser.command_type() == CommandType.C_POP:
-                writer.write_pop(parser.arg1(), parser.arg2())
-        writer.close()
+        _translate(f, dest_file_path, src_file_name[:-3])
+
+
+def _translate(src, dest_file_path, file_name):
+    parser = Parser(src)
+    writer = CodeWriter(dest_file_path)
+    writer.set_file_name(file_name)
+    while parser.has_more_commands():
+        parser.advance()
+        if parser.command_type() == CommandType.C_ARITHMETIC:
+            writer.write_arithmetic(parser.arg1())
+        elif parser.command_type() == CommandType.C_PUSH:
+            writer.write_push(parser.arg1(), parser.arg2())
+        elif parser.command_type() == CommandType.C_POP:
+            writer.write_pop(parser.arg1(), parser.arg2())
+    writer.close()
 
 
 class CommandType:
@@ -504,8 +521,14 @@ M=M+1
 """
 
     def __init__(self, file_path):
+        """
+        file_path "-" writes to standard output.
+        """
         self.file_path = file_path
-        self.file = open(self.file_path, "w")
+        if self.file_path == "-":
+            self.file = sys.stdout
+        else:
+            self.file = open(self.file_path, "w")
 
         self._compare_count = 0
 
@@ -766,7 +789,10 @@ M=M+1
         self._write(code)
 
     def close(self):
-        self.file.close()
+        if self.file is sys.stdout:
+            self.file.flush()
+        else:
+            self.file.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,661 @@
+"""
+Run VM programs directly, without translating, assembling and emulating
+them.
+
+The commands Parser produces are compiled into a flat list of
+(handler, a, b) entries, with labels, functions and statics resolved up
+front. The handlers work on an array-backed RAM laid out like the Hack
+platform and build the same call frames as CodeWriter.write_call and
+write_return. A goto to itself, a call to Sys.halt and a return from the
+entry function stop the program.
+
+    python VMInterpreter.py FunctionCalls/FibonacciElement --print 0,261
+    python VMInterpreter.py SimpleFunction.vm --set 0=317 --set 1=317 --print 0-4
+    python VMInterpreter.py Pong --profile --collapsed pong.folded
+"""
+
+import argparse
+import array
+import collections
+import os
+import sys
+import time
+
+from VMTranslator import CodeWriter, Command, CommandType, Parser, Segment
+
+
+SP = 0
+LCL = 1
+ARG = 2
+THIS = 3
+THAT = 4
+TEMP = 5
+STATIC = 16
+RAM_SIZE = 32768
+TRUE = 0xFFFF
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Run .vm files on a VM interpreter.")
+    arg_parser.add_argument("src_file", help="a .vm file or a directory of .vm files")
+    arg_parser.add_argument("--steps", type=int, help="stop after this many commands")
+    arg_parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="ADDRESS=VALUE",
+        help="set a RAM word before the program starts",
+    )
+    arg_parser.add_argument(
+        "--print",
+        action="append",
+        default=[],
+        metavar="ADDRESSES",
+        help="print RAM words when the program stops, e.g. 0,256-260",
+    )
+    arg_parser.add_argument(
+        "--no-init",
+        action="store_true",
+        help="start at the first command instead of calling Sys.init",
+    )
+    arg_parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="print calls, commands and estimated Hack cycles per function",
+    )
+    arg_parser.add_argument(
+        "--collapsed",
+        metavar="FILE",
+        help="profile and write the call stacks for flame graph tools to FILE",
+    )
+    arg_parser.add_argument(
+        "--weight",
+        choices=["cycles", "commands"],
+        default="cycles",
+        help="what the collapsed stacks count",
+    )
+    arg_parser.add_argument(
+        "-O",
+        "--optimize",
+        action="store_true",
+        help="estimate cycles for code translated with VMTranslator -O",
+    )
+    arg_parser.add_argument(
+        "--shared-calls",
+        action="store_true",
+        help="estimate cycles for code translated with --shared-calls",
+    )
+    arg_parser.add_argument(
+        "--shared-compare",
+        action="store_true",
+        help="estimate cycles for code translated with --shared-compare",
+    )
+    args = arg_parser.parse_args()
+
+    interpreter = VMInterpreter()
+    if os.path.isdir(args.src_file):
+        interpreter.load_directory(args.src_file)
+    else:
+        interpreter.load_file(args.src_file)
+    for assignment in args.set:
+        address, value = assignment.split("=")
+        interpreter.ram[int(address)] = int(value) & 0xFFFF
+    if not args.no_init and "Sys.init" in interpreter.functions:
+        interpreter.bootstrap()
+
+    profiler = None
+    if args.profile or args.collapsed:
+        profiler = Profiler(interpreter, args.optimize, args.shared_calls, args.shared_compare)
+
+    start = time.perf_counter()
+    steps = interpreter.run(args.steps, profiler)
+    elapsed = time.perf_counter() - start
+    for spec in args.print:
+        for address in _parse_addresses(spec):
+            print("RAM[%d] = %d" % (address, interpreter.read(address)))
+    if args.profile:
+        profiler.write_flat(sys.stdout)
+    if args.collapsed:
+        with open(args.collapsed, "w") as f:
+            profiler.write_collapsed(f, args.weight)
+    print("%d commands in %.3fs" % (steps, elapsed), file=sys.stderr)
+
+
+def _parse_addresses(spec):
+    addresses = []
+    for part in spec.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            addresses.extend(range(int(first), int(last) + 1))
+        elif part:
+            addresses.append(int(part))
+    return addresses
+
+
+class VMInterpreter:
+    """
+    Load .vm files with load_file or load_directory, optionally call
+    bootstrap, then run. RAM words are unsigned 16-bit values; read
+    returns them signed.
+
+    A return address saved in a frame is the index of the command after
+    the call, truncated to 16 bits. The interpreter also keeps the return
+    addresses on a list of its own and jumps through that, so programs
+    of any length work.
+    """
+
+    # opcodes of the compiled program
+    PUSH_CONSTANT = 0
+    PUSH_RAM = 1  # static, temp and pointer have fixed addresses
+    PUSH_SEGMENT = 2  # argument, local, this and that go through a base pointer
+    POP_RAM = 3
+    POP_SEGMENT = 4
+    ARITHMETIC = 5
+    GOTO = 6
+    IF_GOTO = 7
+    CALL = 8
+    FUNCTION = 9
+    RETURN = 10
+    HALT = 11
+
+    segment_bases = {
+        Segment.ARGUMENT: ARG,
+        Segment.LOCAL: LCL,
+        Segment.THIS: THIS,
+        Segment.THAT: THAT,
+    }
+
+    def __init__(self):
+        self.ram = array.array("H", bytes(2 * RAM_SIZE))
+        self.pc = 0
+        # name -> index of the function's first command
+        self.functions = {}
+        self.labels = {}
+        self.statics = {}
+        self._commands = []
+        self._code = None
+        self._returns = []
+
+    def load_directory(self, dir_path):
+        for file_name in sorted(os.listdir(dir_path)):
+            if file_name.endswith(".vm"):
+                self.load_file(os.path.join(dir_path, file_name))
+
+    def load_file(self, file_path):
+        file_name = os.path.basename(file_path)[:-3]
+        with open(file_path, "r") as f:
+            self.load_commands(Parser(f).commands(), file_name)
+
+    def load_commands(self, commands, file_name):
+        """
+        Add (command_type, arg1, arg2) commands as produced by
+        Parser.commands. file_name names the static segment they use.
+        """
+        self._code = None
+        for command_type, arg1, arg2 in commands:
+            if command_type == CommandType.C_LABEL:
+                self.labels[arg1] = len(self._commands)
+                continue
+            if command_type == CommandType.C_FUNCTION:
+                if arg1 in self.functions:
+                    raise ValueError("duplicate function: %s" % arg1)
+                self.functions[arg1] = len(self._commands)
+            elif command_type in (CommandType.C_PUSH, CommandType.C_POP) and arg1 == Segment.STATIC:
+                symbol = "%s.%d" % (file_name, arg2)
+                if symbol not in self.statics:
+                    self.statics[symbol] = STATIC + len(self.statics)
+                arg2 = self.statics[symbol]
+            self._commands.append((command_type, arg1, arg2))
+
+    def bootstrap(self):
+        """
+        SP=256, call Sys.init. When Sys.init returns the program stops.
+        """
+        self.ram[SP] = 256
+        self._call(self.functions["Sys.init"], 0, len(self._commands))
+
+    def read(self, address):
+        value = self.ram[address]
+        return value - 0x10000 if value & 0x8000 else value
+
+    def run(self, max_steps=None, profiler=None):
+        """
+        Run until the program stops or max_steps commands have run and
+        return the number of commands run. A Profiler records where the
+        commands run, at the cost of a slower loop.
+        """
+        if self._code is None:
+            self._code = self._compile()
+        if profiler is not None:
+            return self._run_profiled(max_steps, profiler)
+        code = self._code
+        handlers = self._handlers()
+        end = len(code)
+        pc = self.pc
+        steps = 0
+        if max_steps is None:
+            while pc < end:
+                opcode, a, b = code[pc]
+                pc = handlers[opcode](a, b, pc)
+                steps += 1
+        else:
+            while pc < end and steps < max_steps:
+                opcode, a, b = code[pc]
+                pc = handlers[opcode](a, b, pc)
+                steps += 1
+        self.pc = pc
+        return steps
+
+    def _run_profiled(self, max_steps, profiler):
+        code = self._code
+        handlers = self._handlers()
+        costs = profiler.costs
+        end = len(code)
+        pc = self.pc
+        instructions = profiler.instructions
+        cycles = profiler.cycles
+        if pc < end:
+            profiler.start(pc)
+        limit = instructions + max_steps if max_steps is not None else None
+        while pc < end and instructions != limit:
+            opcode, a, b = code[pc]
+            instructions += 1
+            cycles += costs[pc]
+            if opcode == self.CALL:
+                profiler.enter(a, instructions, cycles)
+            elif opcode == self.RETURN:
+                profiler.leave(instructions, cycles)
+            pc = handlers[opcode](a, b, pc)
+        profiler.stop(instructions, cycles)
+        steps = instructions - profiler.instructions
+        profiler.instructions = instructions
+        profiler.cycles = cycles
+        self.pc = pc
+        return steps
+
+    def _compile(self):
+        code = []
+        for i, (command_type, arg1, arg2) in enumerate(self._commands):
+            if command_type == CommandType.C_PUSH:
+                if arg1 == Segment.CONSTANT:
+                    code.append((self.PUSH_CONSTANT, arg2, None))
+                elif arg1 in self.segment_bases:
+                    code.append((self.PUSH_SEGMENT, self.segment_bases[arg1], arg2))
+                else:
+                    code.append((self.PUSH_RAM, self._fixed_address(arg1, arg2), None))
+            elif command_type == CommandType.C_POP:
+                if arg1 in self.segment_bases:
+                    code.append((self.POP_SEGMENT, self.segment_bases[arg1], arg2))
+                else:
+                    code.append((self.POP_RAM, self._fixed_address(arg1, arg2), None))
+            elif command_type == CommandType.C_ARITHMETIC:
+                code.append((self.ARITHMETIC, ARITHMETIC_OPERATIONS[arg1], None))
+            elif command_type == CommandType.C_GOTO:
+                target = self._label_address(arg1)
+                code.append((self.HALT if target == i else self.GOTO, target, None))
+            elif command_type == CommandType.C_IF:
+                code.append((self.IF_GOTO, self._label_address(arg1), None))
+            elif command_type == CommandType.C_CALL:
+                if arg1 == "Sys.halt":
+                    # the OS implements it as an endless loop
+                    code.append((self.HALT, None, None))
+                    continue
+                if arg1 not in self.functions:
+                    raise ValueError("undefined function: %s" % arg1)
+                code.append((self.CALL, self.functions[arg1], arg2))
+            elif command_type == CommandType.C_FUNCTION:
+                code.append((self.FUNCTION, arg2, None))
+            elif command_type == CommandType.C_RETURN:
+                code.append((self.RETURN, None, None))
+            else:
+                raise ValueError("unsupported command type: %s" % command_type)
+        return code
+
+    def _label_address(self, label):
+        if label not in self.labels:
+            raise ValueError("undefined label: %s" % label)
+        return self.labels[label]
+
+    @staticmethod
+    def _fixed_address(segment, index):
+        if segment == Segment.TEMP:
+            return TEMP + index
+        if segment == Segment.POINTER:
+            return THIS + index
+        if segment == Segment.STATIC:
+            # load_commands has already replaced the index with the address
+            return index
+        raise ValueError("unknown segment: %s" % segment)
+
+    def _call(self, target, num_args, return_address):
+        ram = self.ram
+        sp = ram[SP]
+        ram[sp] = return_address & 0xFFFF
+        ram[sp + 1] = ram[LCL]
+        ram[sp + 2] = ram[ARG]
+        ram[sp + 3] = ram[THIS]
+        ram[sp + 4] = ram[THAT]
+        sp += 5
+        ram[ARG] = sp - 5 - num_args
+        ram[LCL] = sp
+        ram[SP] = sp
+        self._returns.append(return_address)
+        self.pc = target
+
+    def _handlers(self):
+        """
+        Return the handler of every opcode. A handler takes the two operands
+        and the index of its command and returns the index of the next
+        command to run.
+        """
+        ram = self.ram
+        returns = self._returns
+        halted = len(self._code)
+
+        def push_constant(value, _, pc):
+            sp = ram[SP]
+            ram[sp] = value
+            ram[SP] = sp + 1
+            return pc + 1
+
+        def push_ram(address, _, pc):
+            sp = ram[SP]
+            ram[sp] = ram[address]
+            ram[SP] = sp + 1
+            return pc + 1
+
+        def push_segment(base, index, pc):
+            sp = ram[SP]
+            ram[sp] = ram[ram[base] + index]
+            ram[SP] = sp + 1
+            return pc + 1
+
+        def pop_ram(address, _, pc):
+            sp = ram[SP] - 1
+            ram[SP] = sp
+            ram[address] = ram[sp]
+            return pc + 1
+
+        def pop_segment(base, index, pc):
+            sp = ram[SP] - 1
+            ram[SP] = sp
+            ram[ram[base] + index] = ram[sp]
+            return pc + 1
+
+        def arithmetic(operation, _, pc):
+            operation(ram)
+            return pc + 1
+
+        def goto(target, _, pc):
+            return target
+
+        def if_goto(target, _, pc):
+            sp = ram[SP] - 1
+            ram[SP] = sp
+            return target if ram[sp] else pc + 1
+
+        def call(target, num_args, pc):
+            sp = ram[SP]
+            ram[sp] = (pc + 1) & 0xFFFF
+            ram[sp + 1] = ram[LCL]
+            ram[sp + 2] = ram[ARG]
+            ram[sp + 3] = ram[THIS]
+            ram[sp + 4] = ram[THAT]
+            sp += 5
+            ram[ARG] = sp - 5 - num_args
+            ram[LCL] = sp
+            ram[SP] = sp
+            returns.append(pc + 1)
+            return target
+
+        def function(num_locals, _, pc):
+            sp = ram[SP]
+            for i in range(sp, sp + num_locals):
+                ram[i] = 0
+            ram[SP] = sp + num_locals
+            return pc + 1
+
+        def return_(_, __, pc):
+            frame = ram[LCL]
+            arg = ram[ARG]
+            ram[arg] = ram[ram[SP] - 1]
+            ram[SP] = arg + 1
+            ram[THAT] = ram[frame - 1]
+            ram[THIS] = ram[frame - 2]
+            ram[ARG] = ram[frame - 3]
+            ram[LCL] = ram[frame - 4]
+            return returns.pop() if returns else halted
+
+        def halt(_, __, pc):
+            return halted
+
+        return [
+            push_constant,
+            push_ram,
+            push_segment,
+            pop_ram,
+            pop_segment,
+            arithmetic,
+            goto,
+            if_goto,
+            call,
+            function,
+            return_,
+            halt,
+        ]
+
+
+class Profiler:
+    """
+    Per-function call counts, and VM commands and estimated Hack cycles
+    both in the function itself (self) and including its callees (total).
+
+    A command is estimated to take as many cycles as CodeWriter emits
+    instructions for it, plus the length of any shared routine it jumps to.
+    Branches in that code make this an upper bound for some commands.
+    The writer options match those of VMTranslator.
+
+    Create the profiler after loading the program and pass it to
+    VMInterpreter.run.
+    """
+
+    # name of the code in front of the first function
+    TOP_LEVEL = "(top level)"
+
+    def __init__(self, interpreter, optimize=False, shared_calls=False, shared_compare=False):
+        self.writer_options = {
+            "optimize": optimize,
+            "shared_calls": shared_calls,
+            "shared_compare": shared_compare,
+        }
+        commands = interpreter._commands
+        self.costs = self._estimate_costs(commands)
+        # name of the function each command belongs to
+        self.function_names = []
+        function_name = self.TOP_LEVEL
+        for command_type, arg1, _ in commands:
+            if command_type == CommandType.C_FUNCTION:
+                function_name = arg1
+            self.function_names.append(function_name)
+
+        self.instructions = 0
+        self.cycles = 0
+        self.calls = collections.Counter()
+        # name -> [commands, cycles]
+        self.self_counts = collections.defaultdict(lambda: [0, 0])
+        self.total_counts = collections.defaultdict(lambda: [0, 0])
+        # "outer;inner" call stack -> [commands, cycles] spent in inner
+        self.stack_counts = collections.defaultdict(lambda: [0, 0])
+        # (name, stack, commands, cycles) when each open call started
+        self._frames = []
+        self._active = collections.Counter()
+        self._mark = (0, 0)
+
+    def start(self, pc):
+        if not self._frames:
+            self._push(self.function_names[pc], self.instructions, self.cycles)
+            self._mark = (self.instructions, self.cycles)
+
+    def enter(self, target, instructions, cycles):
+        self._close_span(instructions, cycles)
+        self._push(self.function_names[target], instructions, cycles)
+
+    def leave(self, instructions, cycles):
+        self._close_span(instructions, cycles)
+        if not self._frames:
+            return
+        name, _, start_instructions, start_cycles = self._frames.pop()
+        self._active[name] -= 1
+        # recursive calls are counted once, by the outermost one
+        if not self._active[name]:
+            counts = self.total_counts[name]
+            counts[0] += instructions - start_instructions
+            counts[1] += cycles - start_cycles
+
+    def stop(self, instructions, cycles):
+        self._close_span(instructions, cycles)
+
+    def _push(self, name, instructions, cycles):
+        stack = "%s;%s" % (self._frames[-1][1], name) if self._frames else name
+        self._frames.append((name, stack, instructions, cycles))
+        self._active[name] += 1
+        self.calls[name] += 1
+
+    def _close_span(self, instructions, cycles):
+        """
+        Charge the commands run since the last call or return to the
+        function on top of the stack.
+        """
+        if self._frames:
+            name, stack, _, _ = self._frames[-1]
+            spent_instructions = instructions - self._mark[0]
+            spent_cycles = cycles - self._mark[1]
+            for counts in (self.self_counts[name], self.stack_counts[stack]):
+                counts[0] += spent_instructions
+                counts[1] += spent_cycles
+        self._mark = (instructions, cycles)
+
+    def rows(self):
+        """
+        Return (name, calls, self commands, total commands, self cycles,
+        total cycles) for every function that ran, the most self cycles
+        first. Calls that have not returned count up to now.
+        """
+        totals = {name: list(counts) for name, counts in self.total_counts.items()}
+        seen = set()
+        for name, _, start_instructions, start_cycles in self._frames:
+            if name in seen:
+                continue
+            seen.add(name)
+            counts = totals.setdefault(name, [0, 0])
+            counts[0] += self.instructions - start_instructions
+            counts[1] += self.cycles - start_cycles
+        rows = []
+        for name in self.calls:
+            self_counts = self.self_counts[name]
+            total_counts = totals.get(name, [0, 0])
+            rows.append((name, self.calls[name], self_counts[0], total_counts[0], self_counts[1], total_counts[1]))
+        rows.sort(key=lambda row: (-row[4], row[0]))
+        return rows
+
+    def write_flat(self, file):
+        cycles = self.cycles or 1
+        file.write("%7s %12s %12s %10s %12s %12s  %s\n" % (
+            "self%", "self cycles", "cycles", "calls", "self cmds", "cmds", "function"))
+        for name, calls, self_instructions, instructions, self_cycles, total_cycles in self.rows():
+            file.write("%6.2f%% %12d %12d %10d %12d %12d  %s\n" % (
+                100.0 * self_cycles / cycles, self_cycles, total_cycles, calls,
+                self_instructions, instructions, name))
+        file.write("%d commands, about %d Hack cycles\n" % (self.instructions, self.cycles))
+
+    def write_collapsed(self, file, weight="cycles"):
+        """
+        Write one "outer;inner count" line per call stack, the format
+        flamegraph.pl and speedscope read. weight is "cycles" or
+        "commands".
+        """
+        column = 1 if weight == "cycles" else 0
+        for stack, counts in sorted(self.stack_counts.items()):
+            if counts[column]:
+                file.write("%s %d\n" % (stack.replace(" ", "_"), counts[column]))
+
+    def _estimate_costs(self, commands):
+        routine_costs = self._routine_costs()
+        costs = {}
+        estimates = []
+        for command in commands:
+            key = self._cost_key(command)
+            if key not in costs:
+                writer = CodeWriter(None, comments=False, **self.writer_options)
+                writer.set_file_name("Profile")
+                writer.write_commands([key])
+                costs[key] = _count_instructions(writer.getvalue()) + sum(
+                    routine_costs[routine] for routine in writer._used_routines)
+            estimates.append(costs[key])
+        return estimates
+
+    @staticmethod
+    def _routine_costs():
+        costs = {
+            "__call": _count_instructions(CodeWriter.call_routine_code),
+            "__return": _count_instructions(CodeWriter.return_routine_code),
+        }
+        for command, jump in CodeWriter.compare_jumps.items():
+            routine = "__%s" % command.lower()
+            costs[routine] = _count_instructions(CodeWriter.compare_routine_code.format(routine=routine, jump=jump))
+        return costs
+
+    @staticmethod
+    def _cost_key(command):
+        """
+        Map commands that translate to code of the same length to one
+        command, so each is translated once.
+        """
+        command_type, arg1, arg2 = command
+        if command_type == CommandType.C_PUSH or command_type == CommandType.C_POP:
+            if arg1 == Segment.STATIC:
+                return (command_type, arg1, 0)
+            return command
+        if command_type in (CommandType.C_LABEL, CommandType.C_GOTO, CommandType.C_IF):
+            return (command_type, "LABEL", None)
+        if command_type == CommandType.C_CALL or command_type == CommandType.C_FUNCTION:
+            return (command_type, "Profile.function", arg2)
+        return command
+
+
+def _count_instructions(code):
+    return sum(1 for line in code.splitlines() if line and not line.startswith(("(", "//")))
+
+
+def _binary(operation):
+    def apply(ram):
+        sp = ram[SP] - 1
+        ram[SP] = sp
+        ram[sp - 1] = operation(ram[sp - 1], ram[sp])
+    return apply
+
+
+def _unary(operation):
+    def apply(ram):
+        sp = ram[SP] - 1
+        ram[sp] = operation(ram[sp])
+    return apply
+
+
+# values are unsigned, so gt and lt flip the sign bits to compare them as
+# signed numbers
+ARITHMETIC_OPERATIONS = {
+    Command.ADD: _binary(lambda x, y: (x + y) & 0xFFFF),
+    Command.SUB: _binary(lambda x, y: (x - y) & 0xFFFF),
+    Command.NEG: _unary(lambda x: -x & 0xFFFF),
+    Command.EQ: _binary(lambda x, y: TRUE if x == y else 0),
+    Command.GT: _binary(lambda x, y: TRUE if x ^ 0x8000 > y ^ 0x8000 else 0),
+    Command.LT: _binary(lambda x, y: TRUE if x ^ 0x8000 < y ^ 0x8000 else 0),
+    Command.AND: _binary(lambda x, y: x & y),
+    Command.OR: _binary(lambda x, y: x | y),
+    Command.NOT: _unary(lambda x: x ^ 0xFFFF),
+}
+
+
+if __name__ == "__main__":
+    main()
@@ -1,67 +1,219 @@
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import io
+import json
 import os
 import sys
 
 
+# part of every cache key, so changes to the generated code invalidate old
+# entries
+TRANSLATOR_VERSION = "1"
+
+
 def main():
-    src_file = sys.argv[1]
-    if os.path.isdir(src_file):
+    arg_parser = argparse.ArgumentParser(description="Translate .vm files into Hack assembly.")
+    arg_parser.add_argument(
+        "src_file",
+        help="a .vm file or a directory of .vm files; - reads stdin and writes stdout",
+    )
+    arg_parser.add_argument(
+        "--name",
+        default="Stdin",
+        help="file name used for static variables when reading stdin",
+    )
+    arg_parser.add_argument(
+        "-O",
+        "--optimize",
+        action="store_true",
+        help="emit the shortest push/pop and arithmetic sequences",
+    )
+    arg_parser.add_argument(
+        "--shared-calls",
+        action="store_true",
+        help="jump to one shared call and return routine instead of inlining them",
+    )
+    arg_parser.add_argument(
+        "--shared-compare",
+        action="store_true",
+        help="jump to one shared routine per comparison instead of inlining eq, gt and lt",
+    )
+    arg_parser.add_argument(
+        "--peephole",
+        action="store_true",
+        help="fold constants and rewrite common command sequences before code generation",
+    )
+    arg_parser.add_argument(
+        "--drop-unused",
+        action="store_true",
+        help="in directory mode, leave out the functions Sys.init cannot reach",
+    )
+    arg_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of processes translating the files of a directory",
+    )
+    arg_parser.add_argument(
+        "--cache-dir",
+        help="reuse the translation of every unchanged file of a directory from this cache",
+    )
+    arg_parser.add_argument(
+        "--no-comments",
+        action="store_true",
+        help="leave out the comment line in front of every command",
+    )
+    args = arg_parser.parse_args()
+
+    src_file = args.src_file
+    if src_file == "-":
+        writer = _create_writer("-", args)
+        writer.write_init()
+        _write_commands(writer, sys.stdin, args.name, args.peephole)
+    elif os.path.isdir(src_file):
         dest_file_name = os.path.basename(src_file) + ".asm"
         dest_file_path = os.path.join(src_file, dest_file_name)
-        writer = CodeWriter(dest_file_path)
+        src_file_names = sorted(name for name in os.listdir(src_file) if name.endswith(".vm"))
+        # only the dropped functions of its own file go with each task, so
+        # that they are part of its cache key
+        dropped_functions = collections.defaultdict(set)
+        if args.drop_unused:
+            call_graph = CallGraph()
+            for src_file_name in src_file_names:
+                call_graph.add_file(os.path.join(src_file, src_file_name))
+            for function_name in _find_unused_functions(call_graph):
+                dropped_functions[call_graph.files[function_name]].add(function_name)
+        tasks = [
+            (os.path.join(src_file, src_file_name), src_file_name[:-3], _writer_options(args),
+             args.peephole, dropped_functions[src_file_name])
+            for src_file_name in src_file_names
+        ]
+        writer = _create_writer(dest_file_path, args)
         writer.write_init()
-        for src_file_name in os.listdir(src_file):
-            if src_file_name.endswith(".vm"):
-                src_file_path = os.path.join(src_file, src_file_name)
-                _write_one_file(writer, src_file_path, src_file_name[:-3])
+        for code, used_routines in _translate_files(tasks, args.jobs, args.cache_dir):
+            writer.write_translated(code, used_routines)
     else:
         src_file_name = os.path.basename(src_file)
         dest_file_name = src_file_name[:-3] + ".asm"
         dest_file_path = os.path.join(os.path.dirname(src_file), dest_file_name)
-        writer = CodeWriter(dest_file_path)
+        writer = _create_writer(dest_file_path, args)
         writer.write_init()
-        _write_one_file(writer, src_file, src_file_name[:-3])
+        _write_one_file(writer, src_file, src_file_name[:-3], args.peephole)
 
     writer.close()
 
 
-def _write_one_file(writer, src_file_path, src_file_name):
+def _create_writer(dest_file_path, args):
+    return CodeWriter(dest_file_path, **_writer_options(args))
+
+
+def _writer_options(args):
+    return {
+        "optimize": args.optimize,
+        "shared_calls": args.shared_calls,
+        "shared_compare": args.shared_compare,
+        "comments": not args.no_comments,
+    }
+
+
+def _translate_files(tasks, jobs=1, cache_dir=None):
+    """
+    Translate every file on its own and return the results in the order
+    of tasks. Files are independent translation units: their statics and
+    generated labels are prefixed with their name. With cache_dir only the
+    files that are not in the cache yet are translated.
+    """
+    results = [None] * len(tasks)
+    if cache_dir is not None:
+        cache = TranslationCache(cache_dir)
+        keys = [cache.key(*task) for task in tasks]
+        results = [cache.fetch(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    missing_tasks = [tasks[i] for i in missing]
+    if jobs <= 1 or len(missing_tasks) <= 1:
+        translated = [_translate_file(task) for task in missing_tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(missing_tasks))) as executor:
+            translated = list(executor.map(_translate_file, missing_tasks))
+    for i, result in zip(missing, translated):
+        results[i] = result
+        if cache_dir is not None:
+            cache.store(keys[i], *result)
+    return results
+
+
+def _translate_file(task):
+    src_file_path, src_file_name, writer_options, peephole, dropped_functions = task
+    writer = CodeWriter(None, **writer_options)
+    _write_one_file(writer, src_file_path, src_file_name, peephole, dropped_functions)
+    return writer.getvalue(), writer._used_routines
+
+
+def _find_unused_functions(call_graph, root="Sys.init"):
+    """
+    Return the functions of call_graph that root cannot reach and report
+    them on stdout.
+    """
+    if root not in call_graph.calls:
+        print("%s is not defined, keeping every function" % root, file=sys.stderr)
+        return set()
+    unused = call_graph.unreachable(root)
+    for function_name in sorted(unused):
+        print("dropped %s (%s)" % (function_name, call_graph.files[function_name]))
+    print("dropped %d of %d functions" % (len(unused), len(call_graph.calls)))
+    return unused
+
+
+def _write_one_file(writer, src_file_path, src_file_name, peephole=False, dropped_functions=None):
     with open(src_file_path, "r") as f:
-        parser = Parser(f)
-        writer.set_file_name(src_file_name)
-        while parser.has_more_commands():
-            parser.advance()
-            if parser.command_type() == CommandType.C_ARITHMETIC:
-                writer.write_arithmetic(parser.arg1())
-            elif parser.command_type() == CommandType.C_PUSH:
-                writer.write_push(parser.arg1(), parser.arg2())
-            elif parser.command_type() == CommandType.C_POP:
-                writer.write_pop(parser.arg1(), parser.arg2())
-            elif parser.command_type() == CommandType.C_LABEL:
-                writer.write_label(parser.arg1())
-            elif parser.command_type() == CommandType.C_GOTO:
-                writer.write_goto(parser.arg1())
-            elif parser.command_type() == CommandType.C_IF:
-                writer.write_if(parser.arg1())
-            elif parser.command_type() == CommandType.C_FUNCTION:
-                writer.write_function(parser.arg1(), parser.arg2())
-            elif parser.command_type() == CommandType.C_RETURN:
-                writer.write_return()
-            elif parser.command_type() == CommandType.C_CALL:
-                writer.write_call(parser.arg1(), parser.arg2())
-            else:
-                raise ValueError("unsupported command type: %s" % parser.command_type())
+        _write_commands(writer, f, src_file_name, peephole, dropped_functions)
+
+
+def _write_commands(writer, src, src_file_name, peephole=False, dropped_functions=None):
+    writer.set_file_name(src_file_name)
+    commands = Parser(src).commands()
+    if dropped_functions:
+        commands = _drop_functions(commands, dropped_functions)
+    if peephole:
+        commands = VMOptimizer().optimize(commands)
+    writer.write_commands(commands)
+
+
+def _drop_functions(commands, dropped_functions):
+    """
+    Skip every command from the declaration of a dropped function up to the
+    next function declaration.
+    """
+    dropping = False
+    for command in commands:
+        if command[0] == CommandType.C_FUNCTION:
+            dropping = command[1] in dropped_functions
+        if not dropping:
+            yield command
         
 
 class CommandType:
-    C_ARITHMETIC = "C_ARITHMETIC"
-    C_PUSH = "C_PUSH"
-    C_POP = "C_POP"
-    C_LABEL = "C_LABEL"
-    C_GOTO = "C_GOTO"
-    C_IF = "C_IF"
-    C_FUNCTION = "C_FUNCTION"
-    C_RETURN = "C_RETURN"
-    C_CALL = "C_CALL"
+    """
+    Opcodes of the (command_type, arg1, arg2) commands Parser produces.
+    They are small ints so CodeWriter can dispatch on them by index.
+    """
+    C_ARITHMETIC = 0
+    C_PUSH = 1
+    C_POP = 2
+    C_LABEL = 3
+    C_GOTO = 4
+    C_IF = 5
+    C_FUNCTION = 6
+    C_RETURN = 7
+    C_CALL = 8
+
+    # only produced by VMOptimizer
+    C_MOVE = 9
+    C_INCREMENT = 10
+    C_IF_NOT = 11
 
 
 class Command:
@@ -106,6 +258,11 @@ class Command:
         RETURN: CommandType.C_RETURN,
         CALL: CommandType.C_CALL,
     }
+    # maps each arithmetic command to the one string object that stands for
+    # it, so that later stages compare and hash the same object
+    ARITHMETIC_COMMANDS = {
+        name: name for name, t in COMMAND_TYPE_MAPPING.items() if t == CommandType.C_ARITHMETIC
+    }
 
 
 class Segment:
@@ -142,6 +299,26 @@ class Parser:
 
         self._function_name = None
 
+    def commands(self):
+        """
+        Yield the remaining commands as (command_type, arg1, arg2) tuples.
+        arg1 is the arithmetic command, the segment, the label scoped to its
+        function or the function name; arg2 is the index, the number of
+        locals or the number of arguments. Unused arguments are None.
+        """
+        if self._cur_line != "":
+            cur_line = self._cur_line
+            self._cur_line = ""
+            yield self._parse(cur_line.split())
+        parse = self._parse
+        for line in self._src_file:
+            i = line.find("//")
+            if i >= 0:
+                line = line[:i]
+            parts = line.split()
+            if parts:
+                yield parse(parts)
+
     def has_more_commands(self):
         if self._cur_line != "":
             return True
@@ -163,43 +340,31 @@ class Parser:
         if i > 0:
             cur_line = cur_line[:i]
 
-        parts = cur_line.split(" ")
-        part0 = parts[0].strip().upper()
-        if part0 in Command.COMMAND_TYPE_MAPPING:
-            t = Command.COMMAND_TYPE_MAPPING[part0]
-            self._cur_command_type = t
-            if t == CommandType.C_ARITHMETIC:
-                self._cur_arg1 = part0
-                self._cur_arg2 = None
-            elif t == CommandType.C_PUSH or t == CommandType.C_POP:
-                segment = parts[1].strip().upper()
-                if segment not in Segment.SEGMENT_MAPPING:
-                    raise ValueError("unknown segment: %s" % parts[1])
-                index = int(parts[2].strip())
-                self._cur_arg1 = Segment.SEGMENT_MAPPING[segment]
-                self._cur_arg2 = index
-            elif t == CommandType.C_LABEL or t == CommandType.C_GOTO or t == CommandType.C_IF:
-                label_name = parts[1].strip()
-                if self._function_name is not None:
-                    label_name = "%s$%s" % (self._function_name, label_name)
-                self._cur_arg1 = label_name
-            elif t == CommandType.C_FUNCTION:
-                function_name = parts[1].strip()
-                num_locals = int(parts[2].strip())
-                self._function_name = function_name
-                self._cur_arg1 = function_name
-                self._cur_arg2 = num_locals
-            elif t == CommandType.C_RETURN:
-                pass
-            elif t == CommandType.C_CALL:
-                function_name = parts[1].strip()
-                num_args = int(parts[2].strip())
-                self._cur_arg1 = function_name
-                self._cur_arg2 = num_args
-            else:
-                raise NotImplementedError("%s is not implemented" % parts[0])
-        else:
-            raise ValueError("unkown command: %s" % parts[0])
+        self._cur_command_type, self._cur_arg1, self._cur_arg2 = self._parse(cur_line.split())
+
+    def _parse(self, parts):
+        name = parts[0].upper()
+        t = Command.COMMAND_TYPE_MAPPING.get(name)
+        if t == CommandType.C_PUSH or t == CommandType.C_POP:
+            segment = Segment.SEGMENT_MAPPING.get(parts[1].upper())
+            if segment is None:
+                raise ValueError("unknown segment: %s" % parts[1])
+            return t, segment, int(parts[2])
+        elif t == CommandType.C_ARITHMETIC:
+            return t, Command.ARITHMETIC_COMMANDS[name], None
+        elif t == CommandType.C_LABEL or t == CommandType.C_GOTO or t == CommandType.C_IF:
+            label_name = parts[1]
+            if self._function_name is not None:
+                label_name = "%s$%s" % (self._function_name, label_name)
+            return t, label_name, None
+        elif t == CommandType.C_FUNCTION:
+            self._function_name = parts[1]
+            return t, parts[1], int(parts[2])
+        elif t == CommandType.C_RETURN:
+            return t, None, None
+        elif t == CommandType.C_CALL:
+            return t, parts[1], int(parts[2])
+        raise ValueError("unkown command: %s" % parts[0])
 
     def command_type(self):
         return self._cur_command_type
@@ -211,6 +376,177 @@ class Parser:
         return self._cur_arg2
 
 
+class TranslationCache:
+    """
+    On-disk cache of translated files. An entry holds the assembly of one
+    .vm file and the shared routines it jumps to. It is keyed by the SHA-256
+    of the file contents, the file name its statics and labels are prefixed
+    with, the translator options and TRANSLATOR_VERSION, and lives at
+    <cache_dir>/<key[:2]>/<key>.json.
+    """
+    read_size = 1 << 20
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def key(self, src_file_path, src_file_name, writer_options, peephole=False, dropped_functions=()):
+        options = {
+            "file_name": src_file_name,
+            "writer": writer_options,
+            "peephole": peephole,
+            "dropped_functions": sorted(dropped_functions),
+        }
+        digest = hashlib.sha256()
+        digest.update(("%s\0%s\0" % (TRANSLATOR_VERSION, json.dumps(options, sort_keys=True))).encode("utf-8"))
+        with open(src_file_path, "rb") as f:
+            for block in iter(lambda: f.read(self.read_size), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def fetch(self, key):
+        """
+        Return the (code, used_routines) stored for key, or None when there
+        is no such entry.
+        """
+        try:
+            with open(self._entry_path(key), "r") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        return entry["code"], set(entry["routines"])
+
+    def store(self, key, code, used_routines):
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        # write next to the entry first so that readers never see a partial file
+        tmp_path = "%s.%d.tmp" % (entry_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump({"code": code, "routines": sorted(used_routines)}, f)
+        os.replace(tmp_path, entry_path)
+
+
+class CallGraph:
+    """
+    The functions of a program, the file each one is declared in and the
+    functions it calls.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.files = {}
+
+    def add_file(self, src_file_path):
+        with open(src_file_path, "r") as f:
+            function_name = None
+            for command_type, arg1, _ in Parser(f).commands():
+                if command_type == CommandType.C_FUNCTION:
+                    function_name = arg1
+                    self.calls.setdefault(function_name, set())
+                    self.files[function_name] = os.path.basename(src_file_path)
+                elif command_type == CommandType.C_CALL and function_name is not None:
+                    self.calls[function_name].add(arg1)
+
+    def reachable(self, root):
+        seen = {root}
+        stack = [root]
+        while stack:
+            for callee in self.calls.get(stack.pop(), ()):
+                if callee not in seen:
+                    seen.add(callee)
+                    stack.append(callee)
+        return seen
+
+    def unreachable(self, root):
+        return set(self.calls) - self.reachable(root)
+
+
+class VMOptimizer:
+    """
+    Rewrite command sequences between the parser and the code writer:
+
+    push constant a / push constant b / add  -> push constant a+b
+        (also sub, and, or, as long as the result is still 0..32767)
+    push constant c / add                    -> increment c
+    push constant c / sub                    -> increment -c
+    push X / pop Y                           -> move X to Y
+    not / if-goto L                          -> if-not-goto L
+
+    Commands are (command_type, arg1, arg2) tuples as read from Parser.
+    A move has the source and destination (segment, index) pairs as its
+    arguments and an increment has its amount as arg2. No rule matches
+    a label, function or call, so a rewrite never spans one. `removed`
+    counts the commands that were saved.
+    """
+    window = 8
+
+    constant_operations = {
+        Command.ADD: lambda a, b: a + b,
+        Command.SUB: lambda a, b: a - b,
+        Command.AND: lambda a, b: a & b,
+        Command.OR: lambda a, b: a | b,
+    }
+
+    def __init__(self):
+        self.removed = 0
+
+    def optimize(self, commands):
+        pending = collections.deque()
+        window = self.window
+        # every rule ends in one of these, so the others skip _reduce
+        last_command_types = (CommandType.C_ARITHMETIC, CommandType.C_POP, CommandType.C_IF)
+        for command in commands:
+            pending.append(command)
+            if command[0] in last_command_types:
+                while self._reduce(pending):
+                    pass
+            if len(pending) > window:
+                yield pending.popleft()
+        yield from pending
+
+    def _reduce(self, pending):
+        """
+        Apply one rule to the end of pending and tell whether it did.
+        """
+        if len(pending) < 2:
+            return False
+        command_type, arg1, arg2 = pending[-1]
+        prev = pending[-2]
+        if command_type == CommandType.C_ARITHMETIC and arg1 in self.constant_operations:
+            if not self._is_constant(prev):
+                return False
+            if len(pending) >= 3 and self._is_constant(pending[-3]):
+                value = self.constant_operations[arg1](pending[-3][2], prev[2])
+                if 0 <= value <= 32767:
+                    self._replace(pending, 3, (CommandType.C_PUSH, Segment.CONSTANT, value))
+                    return True
+            if arg1 == Command.ADD:
+                self._replace(pending, 2, (CommandType.C_INCREMENT, None, prev[2]))
+                return True
+            if arg1 == Command.SUB:
+                self._replace(pending, 2, (CommandType.C_INCREMENT, None, -prev[2]))
+                return True
+        elif command_type == CommandType.C_POP and prev[0] == CommandType.C_PUSH:
+            self._replace(pending, 2, (CommandType.C_MOVE, (prev[1], prev[2]), (arg1, arg2)))
+            return True
+        elif command_type == CommandType.C_IF and prev == (CommandType.C_ARITHMETIC, Command.NOT, None):
+            self._replace(pending, 2, (CommandType.C_IF_NOT, arg1, None))
+            return True
+        return False
+
+    def _replace(self, pending, count, command):
+        for _ in range(count):
+            pending.pop()
+        pending.append(command)
+        self.removed += count - 1
+
+    @staticmethod
+    def _is_constant(command):
+        return command[0] == CommandType.C_PUSH and command[1] == Segment.CONSTANT
+
+
 class CodeWriter:
     push_argument_template = """\
 @{index}
@@ -571,56 +907,363 @@ M=D
 M=M+1
 """
 
-    def __init__(self, file_path):
+    push_templates = {
+        Segment.ARGUMENT: push_argument_template,
+        Segment.LOCAL: push_local_template,
+        Segment.THIS: push_this_template,
+        Segment.THAT: push_that_template,
+        Segment.CONSTANT: push_constant_template,
+        Segment.TEMP: push_temp_template,
+    }
+    pop_templates = {
+        Segment.ARGUMENT: pop_argument_template,
+        Segment.LOCAL: pop_local_template,
+        Segment.THIS: pop_this_template,
+        Segment.THAT: pop_that_template,
+        Segment.TEMP: pop_temp_template,
+    }
+    pointer_names = ("THIS", "THAT")
+    arithmetic_codes = {
+        Command.ADD: add_code,
+        Command.SUB: sub_code,
+        Command.NEG: neg_code,
+        Command.AND: and_code,
+        Command.OR: or_code,
+        Command.NOT: not_code,
+    }
+    compare_codes = {
+        Command.EQ: eq_code,
+        Command.GT: gt_code,
+        Command.LT: lt_code,
+    }
+
+    # optimized mode: SP++ and SP-- fold into the instruction that moves
+    # A to the top of the stack
+    push_d_code = """\
+@SP
+AM=M+1
+A=A-1
+M=D
+"""
+    pop_d_code = """\
+@SP
+AM=M-1
+D=M
+"""
+    binary_code = """\
+@SP
+AM=M-1
+D=M
+A=A-1
+M={operation}
+"""
+    unary_code = """\
+@SP
+A=M-1
+M={operation}
+"""
+    compare_code = """\
+@SP
+AM=M-1
+D=M
+A=A-1
+D=M-D
+M=-1
+@{true_label}
+D;{jump}
+@SP
+A=M-1
+M=0
+({true_label})
+"""
+    # shared call/return routines: a call site passes the argument count in
+    # R13, the callee in R14 and the return address in D
+    call_routine_code = """\
+(__call)
+@SP
+AM=M+1
+A=A-1
+M=D
+@LCL
+D=M
+@SP
+AM=M+1
+A=A-1
+M=D
+@ARG
+D=M
+@SP
+AM=M+1
+A=A-1
+M=D
+@THIS
+D=M
+@SP
+AM=M+1
+A=A-1
+M=D
+@THAT
+D=M
+@SP
+AM=M+1
+A=A-1
+M=D
+@R13
+D=M
+@5
+D=D+A
+@SP
+D=M-D
+@ARG
+M=D
+@SP
+D=M
+@LCL
+M=D
+@R14
+A=M
+0;JMP
+"""
+    return_routine_code = """\
+(__return)
+@LCL
+D=M
+@R13
+M=D
+@5
+A=D-A
+D=M
+@R14
+M=D
+@SP
+AM=M-1
+D=M
+@ARG
+A=M
+M=D
+@ARG
+D=M+1
+@SP
+M=D
+@R13
+AM=M-1
+D=M
+@THAT
+M=D
+@R13
+AM=M-1
+D=M
+@THIS
+M=D
+@R13
+AM=M-1
+D=M
+@ARG
+M=D
+@R13
+AM=M-1
+D=M
+@LCL
+M=D
+@R14
+A=M
+0;JMP
+"""
+    # shared comparison routine: the site passes the return address in D
+    compare_routine_code = """\
+({routine})
+@R15
+M=D
+@SP
+AM=M-1
+D=M
+A=A-1
+D=M-D
+M=-1
+@{routine}_true
+D;{jump}
+@SP
+A=M-1
+M=0
+({routine}_true)
+@R15
+A=M
+0;JMP
+"""
+    segment_base_mapping = {
+        Segment.ARGUMENT: "ARG",
+        Segment.LOCAL: "LCL",
+        Segment.THIS: "THIS",
+        Segment.THAT: "THAT",
+    }
+    binary_operations = {
+        Command.ADD: "D+M",
+        Command.SUB: "M-D",
+        Command.AND: "D&M",
+        Command.OR: "D|M",
+    }
+    unary_operations = {
+        Command.NEG: "-M",
+        Command.NOT: "!M",
+    }
+    compare_jumps = {
+        Command.EQ: "JEQ",
+        Command.GT: "JGT",
+        Command.LT: "JLT",
+    }
+
+    # buffered fragments are written out once there are this many, and at
+    # every function declaration
+    flush_threshold = 1024
+
+    def __init__(self, file_path, optimize=False, shared_calls=False, shared_compare=False, comments=True):
+        """
+        file_path "-" writes to standard output and None to a string buffer
+        that getvalue returns.
+
+        optimize picks the shortest instruction sequence for each segment and
+        index instead of the general templates, and keeps intermediate
+        addresses in R13 rather than in the addr variable.
+
+        shared_calls emits the call and return sequences once, as the
+        __call and __return routines, and makes every call site and return
+        jump to them.
+
+        shared_compare does the same for eq, gt and lt with one routine per
+        comparison.
+
+        comments=False leaves out the "// PUSH ..." line in front of every
+        command.
+        """
         self.file_path = file_path
-        self.file = open(self.file_path, "w")
+        self.optimize = optimize
+        self.shared_calls = shared_calls
+        self.shared_compare = shared_compare
+        self.comments = comments
+        if self.file_path == "-":
+            self.file = sys.stdout
+        elif self.file_path is None:
+            self.file = io.StringIO()
+        else:
+            self.file = open(self.file_path, "w")
 
+        # generated labels are prefixed with the file name and numbered
+        # per file, so a file translates the same wherever it is placed
+        self._label_prefix = ""
         self._compare_count = 0
 
         self._return_address_index = 0
 
+        # names of the shared routines that have been jumped to
+        self._used_routines = set()
+
+        self._buffer = []
+        # the code of the commands that come out the same every time, which
+        # are most of them; statics depend on the file name
+        self._push_codes = {}
+        self._pop_codes = {}
+        self._arithmetic_codes = {}
+        self._return_code = None
+
+        # write_commands looks the method up by the command type
+        handlers = {
+            CommandType.C_ARITHMETIC: lambda command, _: self.write_arithmetic(command),
+            CommandType.C_PUSH: self.write_push,
+            CommandType.C_POP: self.write_pop,
+            CommandType.C_LABEL: lambda label, _: self.write_label(label),
+            CommandType.C_GOTO: lambda label, _: self.write_goto(label),
+            CommandType.C_IF: lambda label, _: self.write_if(label),
+            CommandType.C_FUNCTION: self.write_function,
+            CommandType.C_RETURN: lambda *_: self.write_return(),
+            CommandType.C_CALL: self.write_call,
+            CommandType.C_MOVE: lambda src, dest: self.write_move(src[0], src[1], dest[0], dest[1]),
+            CommandType.C_INCREMENT: lambda _, amount: self.write_increment(amount),
+            CommandType.C_IF_NOT: lambda label, _: self.write_if_not(label),
+        }
+        self._handlers = [handlers[command_type] for command_type in range(len(handlers))]
+
     def set_file_name(self, file_name):
         self.file_name = file_name
+        self._label_prefix = "%s$" % file_name
+        self._compare_count = 0
+        self._return_address_index = 0
+        self._push_codes.clear()
+        self._pop_codes.clear()
+
+    def write_translated(self, code, used_routines):
+        """
+        Append code translated by another writer, along with the shared
+        routines it jumps to.
+        """
+        self._write(code)
+        self._used_routines.update(used_routines)
+
+    def getvalue(self):
+        self._flush()
+        return self.file.getvalue()
+
+    def write_commands(self, commands):
+        """
+        Write (command_type, arg1, arg2) tuples as produced by Parser.commands.
+        """
+        handlers = self._handlers
+        for command_type, arg1, arg2 in commands:
+            handlers[command_type](arg1, arg2)
 
     def _write(self, code):
-        self.file.write(code)
+        buffer = self._buffer
+        buffer.append(code)
+        if len(buffer) >= self.flush_threshold:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self.file.write("".join(self._buffer))
+            self._buffer = []
 
     def write_arithmetic(self, command):
         """
         -1(0xffff) represents true and 0(0x0000) represents false
         """
-        if command == Command.ADD:
-            code = "// ADD\n%s" % self.add_code
-        elif command == Command.SUB:
-            code = "// SUB\n%s" % self.sub_code
-        elif command == Command.NEG:
-            code = "// NEG\n%s" % self.neg_code
-        elif command == Command.EQ:
-            code = "// EQ\n%s" % self.eq_code.format(
-                true_label="TRUE_%d" % self._compare_count,
-                false_label="FALSE_%d" % self._compare_count
-            )
-            self._compare_count += 1
-        elif command == Command.GT:
-            code = "// GT\n%s" % self.gt_code.format(
-                true_label="TRUE_%d" % self._compare_count,
-                false_label="FALSE_%d" % self._compare_count
+        code = self._arithmetic_codes.get(command)
+        if code is not None:
+            self._write(code)
+            return
+        if command in self.compare_jumps:
+            # every comparison has labels of its own
+            if self.shared_compare:
+                self._write_shared_compare(command)
+                return
+            code = self._compare_code(command)
+        else:
+            if self.optimize:
+                code = self._optimized_arithmetic(command)
+            else:
+                code = self.arithmetic_codes[command]
+            if self.comments:
+                code = "// %s\n%s" % (command, code)
+            self._arithmetic_codes[command] = code
+            self._write(code)
+            return
+        if self.comments:
+            code = "// %s\n%s" % (command, code)
+        self._write(code)
+
+    def _compare_code(self, command):
+        if self.optimize:
+            # the result slot is set to true first and cleared if the jump
+            # is not taken
+            code = self.compare_code.format(
+                true_label="%sTRUE_%d" % (self._label_prefix, self._compare_count),
+                jump=self.compare_jumps[command],
             )
-            self._compare_count += 1
-        elif command == Command.LT:
-            code = "// LT\n%s" % self.lt_code.format(
-                true_label="TRUE_%d" % self._compare_count,
-                false_label="FALSE_%d" % self._compare_count
+        else:
+            code = self.compare_codes[command].format(
+                true_label="%sTRUE_%d" % (self._label_prefix, self._compare_count),
+                false_label="%sFALSE_%d" % (self._label_prefix, self._compare_count)
             )
-            self._compare_count += 1
-        elif command == Command.AND:
-            code = "// AND\n%s" % self.and_code
-        elif command == Command.OR:
-            code = "// OR\n%s" % self.or_code
-        elif command == Command.NOT:
-            code = "// NOT\n%s" % self.not_code
-
-        self._write(code)
+        self._compare_count += 1
+        return code
 
     def write_push(self, segment, index):
         """
@@ -790,51 +1433,174 @@ M=M+1
         @THAT
         M=D
         """
-        if segment == Segment.ARGUMENT:
-            code = self.push_argument_template.format(index=index)
-        elif segment == Segment.LOCAL:
-            code = self.push_local_template.format(index=index)
-        elif segment == Segment.THIS:
-            code = self.push_this_template.format(index=index)
-        elif segment == Segment.THAT:
-            code = self.push_that_template.format(index=index)
-        elif segment == Segment.STATIC:
-            code = self.push_static_template.format(index=index, file_name=self.file_name)
-        elif segment == Segment.CONSTANT:
-            code = self.push_constant_template.format(index=index)
-        elif segment == Segment.POINTER:
-            pointer_mapping = {
-                0: "THIS",
-                1: "THAT",
-            }
-            code = self.push_pointer_template.format(pointer=pointer_mapping[index])
-        elif segment == Segment.TEMP:
-            code = self.push_temp_template.format(index=index)
-        code = "// PUSH %s %s\n%s" % (segment, index, code)
+        code = self._push_codes.get((segment, index))
+        if code is None:
+            if self.optimize:
+                code = self._optimized_push(segment, index)
+            elif segment == Segment.POINTER:
+                code = self.push_pointer_template.format(pointer=self.pointer_names[index])
+            elif segment == Segment.STATIC:
+                code = self.push_static_template.format(index=index, file_name=self.file_name)
+            else:
+                code = self.push_templates[segment].format(index=index)
+            if self.comments:
+                code = "// PUSH %s %s\n%s" % (segment, index, code)
+            self._push_codes[(segment, index)] = code
         self._write(code)
 
     def write_pop(self, segment, index):
-        if segment == Segment.ARGUMENT:
-            code = self.pop_argument_template.format(index=index)
-        elif segment == Segment.LOCAL:
-            code = self.pop_local_template.format(index=index)
-        elif segment == Segment.THIS:
-            code = self.pop_this_template.format(index=index)
-        elif segment == Segment.THAT:
-            code = self.pop_that_template.format(index=index)
-        elif segment == Segment.STATIC:
-            code = self.pop_static_template.format(index=index, file_name=self.file_name)
-        elif segment == Segment.POINTER:
-            pointer_mapping = {
-                0: "THIS",
-                1: "THAT",
-            }
-            code = self.pop_pointer_template.format(pointer=pointer_mapping[index])
-        elif segment == Segment.TEMP:
-            code = self.pop_temp_template.format(index=index)
-        code = "// POP %s %s\n%s" % (segment, index, code)
+        code = self._pop_codes.get((segment, index))
+        if code is None:
+            if self.optimize:
+                code = self._optimized_pop(segment, index)
+            elif segment == Segment.POINTER:
+                code = self.pop_pointer_template.format(pointer=self.pointer_names[index])
+            elif segment == Segment.STATIC:
+                code = self.pop_static_template.format(index=index, file_name=self.file_name)
+            else:
+                code = self.pop_templates[segment].format(index=index)
+            if self.comments:
+                code = "// POP %s %s\n%s" % (segment, index, code)
+            self._pop_codes[(segment, index)] = code
+        self._write(code)
+
+    def write_move(self, src_segment, src_index, dest_segment, dest_index):
+        """
+        push src_segment src_index / pop dest_segment dest_index without
+        going through the stack. Like the other commands that only come from
+        VMOptimizer it always uses the short sequences.
+        """
+        code = ""
+        if self.comments:
+            code = "// MOVE %s %s %s %s\n" % (src_segment, src_index, dest_segment, dest_index)
+        if dest_segment in self.segment_base_mapping and dest_index > 6:
+            # the address goes to R13 first, as in pop
+            code += "@%d\nD=A\n@%s\nD=D+M\n@R13\nM=D\n" % (
+                dest_index, self.segment_base_mapping[dest_segment])
+            code += self._load_d(src_segment, src_index) + "@R13\nA=M\nM=D\n"
+        else:
+            if dest_segment in self.segment_base_mapping:
+                dest_address = self._segment_address(dest_segment, dest_index, keep_d=True)
+            else:
+                dest_address = "@%s\n" % self._fixed_address(dest_segment, dest_index)
+            if src_segment == Segment.CONSTANT and src_index <= 1:
+                code += dest_address + "M=%d\n" % src_index
+            else:
+                code += self._load_d(src_segment, src_index) + dest_address + "M=D\n"
+        self._write(code)
+
+    def write_increment(self, amount):
+        """
+        Add amount to the top of the stack in place.
+        """
+        code = ""
+        if self.comments:
+            code = "// INCREMENT %d\n" % amount
+        if amount == 1 or amount == -1:
+            code += "@SP\nA=M-1\nM=M%+d\n" % amount
+        elif amount > 0:
+            code += "@%d\nD=A\n@SP\nA=M-1\nM=D+M\n" % amount
+        elif amount < 0:
+            code += "@%d\nD=A\n@SP\nA=M-1\nM=M-D\n" % -amount
+        self._write(code)
+
+    def write_if_not(self, label):
+        """
+        not / if-goto label: jump unless the popped value is -1.
+        """
+        code = (
+            "@SP\n"
+            "AM=M-1\n"
+            "D=M+1\n"
+            "@{label}\n"
+            "D;JNE\n"
+        ).format(label=label)
+        if self.comments:
+            code = "// IF-NOT-GOTO %s\n%s" % (label, code)
         self._write(code)
 
+    def _optimized_arithmetic(self, command):
+        if command in self.binary_operations:
+            return self.binary_code.format(operation=self.binary_operations[command])
+        return self.unary_code.format(operation=self.unary_operations[command])
+
+    def _optimized_push(self, segment, index):
+        """
+        push local 0     push local 1     push local 8     push temp 2
+        @LCL             @LCL             @8               @7
+        A=M              A=M+1            D=A              D=M
+        D=M              D=M              @LCL             (push D)
+        (push D)         (push D)         A=D+M
+                                          D=M
+                                          (push D)
+        """
+        # 0 and 1 are ALU constants and need not pass through D
+        if segment == Segment.CONSTANT and index <= 1:
+            return "@SP\nAM=M+1\nA=A-1\nM=%d\n" % index
+        return self._load_d(segment, index) + self.push_d_code
+
+    def _optimized_pop(self, segment, index):
+        """
+        pop local 1      pop local 8      pop temp 2
+        (pop D)          @8               (pop D)
+        @LCL             D=A              @7
+        A=M+1            @LCL             M=D
+        M=D              D=D+M
+                         @R13
+                         M=D
+                         (pop D)
+                         @R13
+                         A=M
+                         M=D
+        """
+        if segment in self.segment_base_mapping:
+            if index <= 6:
+                # stepping A costs one instruction per index, which beats
+                # saving the address in R13 up to index 6
+                return self.pop_d_code + self._segment_address(segment, index, keep_d=True) + "M=D\n"
+            base = self.segment_base_mapping[segment]
+            return (
+                "@%d\n"
+                "D=A\n"
+                "@%s\n"
+                "D=D+M\n"
+                "@R13\n"
+                "M=D\n"
+                "%s"
+                "@R13\n"
+                "A=M\n"
+                "M=D\n"
+            ) % (index, base, self.pop_d_code)
+        return self.pop_d_code + "@%s\nM=D\n" % self._fixed_address(segment, index)
+
+    def _load_d(self, segment, index):
+        if segment == Segment.CONSTANT:
+            return "@%d\nD=A\n" % index
+        if segment in self.segment_base_mapping:
+            return self._segment_address(segment, index) + "D=M\n"
+        return "@%s\nD=M\n" % self._fixed_address(segment, index)
+
+    def _segment_address(self, segment, index, keep_d=False):
+        """
+        Set A to the address of a segment entry. Small indexes step A up from
+        the base, larger ones add the index through D unless keep_d is set.
+        """
+        base = self.segment_base_mapping[segment]
+        if index == 0:
+            return "@%s\nA=M\n" % base
+        if index <= 2 or keep_d:
+            return "@%s\nA=M+1\n" % base + "A=A+1\n" * (index - 1)
+        return "@%d\nD=A\n@%s\nA=D+M\n" % (index, base)
+
+    def _fixed_address(self, segment, index):
+        if segment == Segment.TEMP:
+            return "R%d" % (5 + index)
+        if segment == Segment.POINTER:
+            return ("THIS", "THAT")[index]
+        if segment == Segment.STATIC:
+            return "%s.%d" % (self.file_name, index)
+        raise ValueError("unknown segment: %s" % segment)
+
     def write_init(self):
         """
         SP=256
@@ -849,28 +1615,60 @@ M=M+1
         self._write(set_sp)
         self.write_call("Sys.init", 0)
 
+    def write_shared_routines(self):
+        """
+        Write the shared routines that have been used, behind a loop that
+        stops a program whose last command is not a jump from running into
+        them.
+        """
+        if not self._used_routines:
+            return
+        routines = [("END", "(__end)\n@__end\n0;JMP\n")]
+        if "__call" in self._used_routines:
+            routines.append(("CALL ROUTINE", self.call_routine_code))
+        if "__return" in self._used_routines:
+            routines.append(("RETURN ROUTINE", self.return_routine_code))
+        for command, jump in sorted(self.compare_jumps.items()):
+            routine = "__%s" % command.lower()
+            if routine in self._used_routines:
+                code = self.compare_routine_code.format(routine=routine, jump=jump)
+                routines.append(("%s ROUTINE" % command, code))
+        for name, code in routines:
+            if self.comments:
+                code = "// %s\n%s" % (name, code)
+            self._write(code)
+        self._used_routines.clear()
+
     def write_label(self, label):
         code = "({label})\n".format(label=label)
         self._write(code)
 
     def write_goto(self, label):
+        self._write(self._goto_code(label))
+
+    def _goto_code(self, label):
         code = (
             "@{label}\n"        
             "0;JMP\n"
         ).format(label=label)
-        code = "// GOTO %s\n%s" % (label, code)
-        self._write(code)
+        if self.comments:
+            code = "// GOTO %s\n%s" % (label, code)
+        return code
 
     def write_if(self, label):
-        code = (
-            "@SP\n"        
-            "M=M-1\n"
-            "A=M\n"
-            "D=M\n"
-            "@{label}\n"
-            "D;JNE\n"
-        ).format(label=label)
-        code = "// IF-GOTO %s\n%s" % (label, code)
+        if self.optimize:
+            code = "%s@%s\nD;JNE\n" % (self.pop_d_code, label)
+        else:
+            code = (
+                "@SP\n"        
+                "M=M-1\n"
+                "A=M\n"
+                "D=M\n"
+                "@{label}\n"
+                "D;JNE\n"
+            ).format(label=label)
+        if self.comments:
+            code = "// IF-GOTO %s\n%s" % (label, code)
         self._write(code)
 
     def write_call(self, function_name, num_args):
@@ -884,8 +1682,30 @@ M=M+1
         LCL = SP
         goto function_name
         (return-address)
+
+        With shared_calls the call site only sets up the registers of the
+        __call routine:
+
+        @num_args
+        D=A
+        @R13
+        M=D
+        @function_name
+        D=A
+        @R14
+        M=D
+        @return-address
+        D=A
+        @__call
+        0;JMP
+        (return-address)
         """
+        if self.shared_calls:
+            self._write_shared_call(function_name, num_args)
+            return
         def push_d():
+            if self.optimize:
+                return self.push_d_code
             return (
                 "@SP\n"
                 "A=M\n"
@@ -893,7 +1713,7 @@ M=M+1
                 "@SP\n"
                 "M=M+1\n"
             )
-        return_address = "%s$return%s" % (function_name, self._return_address_index)
+        return_address = "%s%s$return%s" % (self._label_prefix, function_name, self._return_address_index)
         push_return_address = (
             "@{return_address}\n"            
             "D=A\n"
@@ -923,15 +1743,17 @@ M=M+1
             "M=D\n"
         )
 
-        self._write(push_return_address)
-        self._write(push_lcl)
-        self._write(push_arg)
-        self._write(push_this)
-        self._write(push_that)
-        self._write(arg)
-        self._write(lcl)
-        self.write_goto(function_name)
-        self._write("(%s)\n" % return_address)
+        self._write("".join((
+            push_return_address,
+            push_lcl,
+            push_arg,
+            push_this,
+            push_that,
+            arg,
+            lcl,
+            self._goto_code(function_name),
+            "(%s)\n" % return_address,
+        )))
 
         self._return_address_index += 1
         
@@ -947,6 +1769,18 @@ M=M+1
         LCL = *(FRAME - 4)
         goto RET
         """
+        if self.shared_calls:
+            self._used_routines.add("__return")
+        if self._return_code is None:
+            self._return_code = self._build_return_code()
+        self._write(self._return_code)
+
+    def _build_return_code(self):
+        if self.shared_calls:
+            code = "@__return\n0;JMP\n"
+            if self.comments:
+                code = "// RETURN\n%s" % code
+            return code
         frame = (
             "@LCL\n"
             "D=M\n"
@@ -1023,16 +1857,64 @@ M=M+1
             "A=M\n"
             "0;JMP\n"
         )
-        code = frame + ret + set_return_value + set_sp + that + this + arg + lcl + goto_caller
+        return frame + ret + set_return_value + set_sp + that + this + arg + lcl + goto_caller
+
+    def _write_shared_compare(self, command):
+        return_address = "%sCOMPARE_%d" % (self._label_prefix, self._compare_count)
+        self._compare_count += 1
+        self._used_routines.add("__%s" % command.lower())
+        code = (
+            "@{return_address}\n"
+            "D=A\n"
+            "@__{routine}\n"
+            "0;JMP\n"
+            "({return_address})\n"
+        ).format(return_address=return_address, routine=command.lower())
+        if self.comments:
+            code = "// %s\n%s" % (command, code)
+        self._write(code)
+
+    def _write_shared_call(self, function_name, num_args):
+        return_address = "%s%s$return%s" % (self._label_prefix, function_name, self._return_address_index)
+        self._return_address_index += 1
+        self._used_routines.add("__call")
+        if num_args <= 1:
+            set_num_args = "@R13\nM=%d\n" % num_args
+        else:
+            set_num_args = "@%d\nD=A\n@R13\nM=D\n" % num_args
+        code = (
+            "{set_num_args}"
+            "@{function_name}\n"
+            "D=A\n"
+            "@R14\n"
+            "M=D\n"
+            "@{return_address}\n"
+            "D=A\n"
+            "@__call\n"
+            "0;JMP\n"
+            "({return_address})\n"
+        ).format(
+            function_name=function_name,
+            set_num_args=set_num_args,
+            return_address=return_address,
+        )
+        if self.comments:
+            code = "// CALL %s %s\n%s" % (function_name, num_args, code)
         self._write(code)
 
     def write_function(self, function_name, num_locals):
+        self._flush()
         self._write("(%s)\n" % function_name)
         for _ in range(num_locals):
             self.write_push(Segment.CONSTANT, 0)
 
     def close(self):
-        self.file.close()
+        self.write_shared_routines()
+        self._flush()
+        if self.file is sys.stdout:
+            self.file.flush()
+        elif self.file_path is not None:
+            self.file.close()
 
 
 if __name__ == "__main__":
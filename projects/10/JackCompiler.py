@@ -54,14 +54,30 @@ Program structure:
     keywordConstant: 'true' | 'false' | 'null' | 'this'
 """
 
+import argparse
+import io
 import os
 import sys
 import string
 
 
 def main():
-    src_file = sys.argv[1]
-    if os.path.isdir(src_file):
+    arg_parser = argparse.ArgumentParser(description="Compile .jack files into XML parse trees.")
+    arg_parser.add_argument(
+        "src_file",
+        help="a .jack file or a directory of .jack files; - reads stdin and writes stdout",
+    )
+    arg_parser.add_argument(
+        "--tokens",
+        action="store_true",
+        help="with -, write the token XML instead of the compilation XML",
+    )
+    args = arg_parser.parse_args()
+
+    src_file = args.src_file
+    if src_file == "-":
+        _compile_stdio(args.tokens)
+    elif os.path.isdir(src_file):
         for src_file_name in os.listdir(src_file):
             if src_file_name.endswith(".jack"):
                 src_file_path = os.path.join(src_file, src_file_name)
@@ -102,6 +118,17 @@ def _compile(src_file, token_file, compilation_result_file):
         compilation_engine.compile_class()
 
 
+def _compile_stdio(tokens):
+    # translate CRLF like open() does for the source files
+    tokenizer = JackTokenizer(io.TextIOWrapper(sys.stdin.buffer, newline=None))
+    if tokens:
+        _write_token(tokenizer, sys.stdout)
+    else:
+        compilation_engine = CompilationEngine(tokenizer, sys.stdout)
+        compilation_engine.compile_class()
+    sys.stdout.flush()
+
+
 def _write_token(tokenizer, writer):
     writer.write("<tokens>\n")
     while tokenizer.has_more_tokens():